@@ -1,195 +1,479 @@
 import asyncio
+import csv
+import hashlib
 import json
-from typing import Any, Dict, List, Optional
+import sys
+from typing import Any, Dict, List, Optional, Tuple
 import io
 
+from cachetools import LRUCache
+
+try:
+    # orjson parses tool-call arguments several times faster than the stdlib
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+from asyncutils.async_cache import SingleFlightCache
 from Agents.AsyncSQLQueryGeneratorAgent import AsyncSQLQueryGeneratorAgent
-from Agents.VisualizationAgent import VisualizationAgent
+from Agents.VisualizationAgent import (
+    VisualizationAgent,
+    RUN_POLL_INITIAL_INTERVAL,
+    RUN_POLL_BACKOFF,
+    RUN_POLL_MAX_INTERVAL,
+)
+
+# Run events after which there is nothing left to wait for on the stream
+RUN_STOP_EVENTS = {
+    "thread.run.requires_action",
+    "thread.run.completed",
+    "thread.run.failed",
+    "thread.run.cancelled",
+    "thread.run.expired",
+    "thread.run.incomplete",
+}
+
+# Run statuses after which a new run can be started on the thread
+RUN_FINAL_STATUSES = {"completed", "failed", "cancelled", "expired", "incomplete"}
+
+# Safety net in case the agent keeps asking for tools after getting their outputs.
+# One more round is answered with _TOOL_LIMIT_OUTPUT, after that a final run without tools is forced.
+MAX_TOOL_ROUNDS = 3
+
+# Max number of idle upload buffers kept around for chart re-uploads
+BYTESIO_POOL_SIZE = 8
+
+# Fixed text used in tool outputs and tool messages
+_STATCAST_PREAMBLE = "[Tool] Here is the data from statcast_query tool to help you answer my query:\n"
+_CHART_PREAMBLE = "[Tool] Here is the chart from the visualization tool to help you answer my query."
+_CHART_NOTE = "The chart was created and will be shown to the user below your answer."
+_ERROR_TEMPLATE = "[Tool] Tool {name} was not able to be completed at this time"
+# Tool output for calls past MAX_TOOL_ROUNDS, so the run still ends with an answer
+_TOOL_LIMIT_OUTPUT = (
+    "[Tool] No more tool calls can be made for this question. "
+    "Answer now with the data you already have."
+)
+_FINAL_ANSWER_INSTRUCTIONS = "Tools are not available anymore. Answer the user's question with what you know."
+# Run instructions for the large results, on top of the assistant's own
+_LARGE_RESULT_INSTRUCTIONS = (
+    "When a statcast_query result only shows the first rows and names a file_id, the full result "
+    "is a CSV file attached to this thread. Open it with code interpreter to work with all of the rows."
+)
 
 class AnalystAgent:
     """
     Uses an existing Analyst Assistant (in the Assistants API) to:
       - Start a run on a thread that has the user's last message.
       - If the agent calls some tools, we parse the calls, run them in parallel,
-        cancel the run, and post their outputs to the thread.
-      - Then we do a second run (tool_choice="none") so the agent can finalize its answer.
+        and submit their outputs back to the same run.
+      - The run then continues in place so the agent can finalize its answer.
+      - Any charts from the visualization tool are posted to the thread afterwards.
     """
 
-    def __init__(self, openai_client, analyst_assistant_id: str, query_agent: AsyncSQLQueryGeneratorAgent, viz_agent: VisualizationAgent):
+    def __init__(self, openai_client, analyst_assistant_id: str, query_agent: AsyncSQLQueryGeneratorAgent, viz_agent: VisualizationAgent, viz_file_cache_size: int = 256, max_inline_rows: int = 200):
         """
         :param openai_client: The async client with Beta endpoints (e.g., AsyncOpenAI)
         :param analyst_assistant_id: ID of the previously created "Analyst Assistant"
+        :param viz_file_cache_size: how many code_interpreter image ids -> re-uploaded file ids to remember
+        :param max_inline_rows: CSV results longer than this are uploaded as a file and only previewed in the tool output
         """
         self.client = openai_client
         self.analyst_assistant_id = analyst_assistant_id
         self.query_agent = query_agent
         self.viz_agent = viz_agent
+        self.max_inline_rows = max_inline_rows
+        # tool name -> coroutine function taking the parsed arguments
+        self._tool_handlers = {
+            "statcast_query": lambda args: self.query_agent.generate_and_run_queries(args["query_descriptions"]),
+            "visualization_tool": lambda args: self.viz_agent.create_visualization(args["visualization_description"]),
+        }
+        # original image_file_id -> re-uploaded vision file_id
+        self._viz_file_cache = SingleFlightCache(LRUCache(maxsize=viz_file_cache_size))
+        # reusable upload buffers for chart re-uploads
+        self._bytesio_pool: List[io.BytesIO] = []
 
     async def handle_query(self, thread_id: str) -> None:
         """
-        1) Start a run with create_and_poll.
-        2) If the run calls tools, gather them in parallel, then cancel the run.
-        3) Post the tool results to the thread.
-        4) Start a second run with tool_choice="none" to finalize the answer.
+        1) Start a streamed run and wait for it to stop or ask for tools.
+        2) If the run calls tools, gather them in parallel.
+        3) Submit the tool outputs to the same run and let it finish the answer.
+        4) Post any charts to the thread once the run is done.
+        5) Detach and delete the large query results uploaded for this turn.
         """
-        # 1) Start the first run
-        print(f"[AnalystAgent] Starting first run on thread {thread_id}...")
-        run1 = await self.client.beta.threads.runs.create_and_poll(
-            thread_id=thread_id,
-            assistant_id=self.analyst_assistant_id,
-            poll_interval_ms=2000
+        # data digest -> file_id of the large query results uploaded during this turn,
+        # they are attached to the thread while the run needs them and deleted afterwards
+        uploaded_files: Dict[str, str] = {}
+        try:
+            await self._run_with_tools(thread_id, uploaded_files)
+        finally:
+            if uploaded_files:
+                await self._discard_uploaded_files(thread_id, list(uploaded_files.values()))
+
+    async def _run_with_tools(self, thread_id: str, uploaded_files: Dict[str, str]) -> None:
+        # 1) Start the run
+        print(f"[AnalystAgent] Starting run on thread {thread_id}...")
+        run = await self._stream_run(
+            self.client.beta.threads.runs.stream(
+                thread_id=thread_id,
+                assistant_id=self.analyst_assistant_id,
+                additional_instructions=_LARGE_RESULT_INSTRUCTIONS
+            )
         )
-        print(f"[AnalystAgent] run1 ended with status={run1.status}")
+        print(f"[AnalystAgent] run ended with status={run.status}")
 
         # 2) If run completed with no tool calls, done
-        if run1.status == "completed" and not run1.required_action:
+        if run.status == "completed" and not run.required_action:
             print("[AnalystAgent] The agent answered without tools. Done.")
             return
 
-        # 3) If the run is waiting for tool outputs:
-        if run1.status == "requires_action":
-            required = run1.required_action
-            if required.type == "submit_tool_outputs":
-                tool_calls = required.submit_tool_outputs.tool_calls
+        # 3) While the run is waiting for tool outputs, run the tools and submit them
+        chart_file_ids = []
+        tool_rounds = 0
+        while run.status == "requires_action":
+            required = run.required_action
+            if required.type != "submit_tool_outputs":
+                print(f"[AnalystAgent] The run requires some other action: {required.type}")
+                return
+
+            tool_calls = required.submit_tool_outputs.tool_calls
+
+            if tool_rounds > MAX_TOOL_ROUNDS:
+                # it was already told to answer and still asked for tools
+                print(f"[AnalystAgent] Still calling tools after {MAX_TOOL_ROUNDS} rounds, forcing a final answer.")
+                run = await self._final_answer_run(thread_id, run)
+                print(f"[AnalystAgent] final run ended with status={run.status}")
+                break
+
+            if tool_rounds == MAX_TOOL_ROUNDS:
+                # Don't run them, but keep the run (and the tool data it already has) going
+                print(f"[AnalystAgent] Giving up on tools after {tool_rounds} rounds, asking for the answer.")
+                tool_outputs = [{"tool_call_id": call.id, "output": _TOOL_LIMIT_OUTPUT} for call in tool_calls]
+            else:
                 print(f"[AnalystAgent] The agent called {len(tool_calls)} tool(s). We'll handle them now.")
-                print(tool_calls)
 
-                # Cancel this run so we can attach messages ourselves
-                await self.client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run1.id)
+                # Execute each tool call in parallel
+                files_before = len(uploaded_files)
+                tool_outputs, new_chart_ids = await self._handle_tool_calls_in_parallel(tool_calls, uploaded_files)
+                chart_file_ids.extend(new_chart_ids)
 
-                # Execute each tool call in parallel, then post the results
-                await self._handle_tool_calls_in_parallel(thread_id, tool_calls)
+                # Large results were uploaded, let code interpreter open them
+                if len(uploaded_files) > files_before:
+                    await self._attach_files(thread_id, list(uploaded_files.values()))
+            tool_rounds += 1
 
-                # Final run with tool_choice="none" to produce the final answer
-                run2 = await self.client.beta.threads.runs.create_and_poll(
+            # Hand the results back to the same run so the model continues in place
+            run = await self._stream_run(
+                self.client.beta.threads.runs.submit_tool_outputs_stream(
                     thread_id=thread_id,
-                    assistant_id=self.analyst_assistant_id,
-                    poll_interval_ms=2000,
-                    tool_choice="none",  # no more calls
-                    additional_instructions="\nIMPORTANT: We have already handled the tool calls for the above user query, and added the results of the tools above. Use those results in your response to the user query."
+                    run_id=run.id,
+                    tool_outputs=tool_outputs
                 )
-                print(f"[AnalystAgent] run2 ended with status={run2.status}")
-            else:
-                print(f"[AnalystAgent] The run requires some other action: {required.type}")
+            )
+            print(f"[AnalystAgent] run ended with status={run.status}")
+
+        if run.status not in ("completed", "requires_action"):
+            print(f"[AnalystAgent] The run ended with status={run.status}, no further steps to do.")
+
+        # 4) The thread is locked while a run is active, so charts are posted afterwards
+        for file_id in chart_file_ids:
+            await self._post_chart(thread_id, file_id)
+
+    async def _final_answer_run(self, thread_id: str, run):
+        """
+        Cancel a run that keeps asking for tools and start one that can't call any
+        (tool_choice="none"), so the thread still ends with an assistant message.
+        """
+        await self.client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
+        # a new run can only start once the old one has left "cancelling"
+        interval = RUN_POLL_INITIAL_INTERVAL
+        while run.status not in RUN_FINAL_STATUSES:
+            await asyncio.sleep(interval)
+            interval = min(interval * RUN_POLL_BACKOFF, RUN_POLL_MAX_INTERVAL)
+            run = await self.client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+
+        return await self._stream_run(
+            self.client.beta.threads.runs.stream(
+                thread_id=thread_id,
+                assistant_id=self.analyst_assistant_id,
+                tool_choice="none",
+                additional_instructions=_FINAL_ANSWER_INSTRUCTIONS
+            )
+        )
+
+    async def _stream_run(self, stream_manager):
+        """
+        Consume a streamed run (new run or tool output submission) and return the run
+        object as soon as it stops or asks for tool outputs, instead of sleeping between
+        status polls.
+        """
+        run = None
+        async with stream_manager as stream:
+            async for event in stream:
+                if event.event in RUN_STOP_EVENTS:
+                    run = event.data
+                    break
+
+        if run is None:
+            # stream closed without a terminal event, fall back to the latest snapshot
+            run = stream.current_run
+        return run
+
+    async def _handle_tool_calls_in_parallel(self, tool_calls: List, uploaded_files: Dict[str, str]) -> Tuple[List[Dict[str, str]], List[str]]:
+        """
+        Parse each function call. We'll run them all concurrently in a TaskGroup,
+        then build one tool output per call for submit_tool_outputs.
+        Large query results are uploaded as files and recorded in uploaded_files (digest -> file_id).
+
+        :return: (tool_outputs, chart_file_ids) where chart_file_ids are the re-uploaded
+                 visualization images that should be shown to the user.
+        """
+        # 1) Several statcast_query calls in one round are run as a single query batch, so their
+        #    SQL is generated in one LLM call and small results share one DB round-trip.
+        statcast_calls = [call for call in tool_calls if call.function.name == "statcast_query"]
+        shared_outputs = None
+        if len(statcast_calls) > 1:
+            shared_outputs = asyncio.ensure_future(self._run_statcast_calls_together(statcast_calls))
+
+        # 2) Build a coroutine for each tool call. Each one runs its tool and then
+        #    builds its output right away, so a chart re-upload overlaps with slower
+        #    tools that are still running instead of waiting for all of them.
+        coros = [self._run_and_build(call, uploaded_files, shared_outputs) for call in tool_calls]
+
+        # 3) run them all concurrently
+        # _run_tool never raises, so one failing tool doesn't cancel its siblings
+        if sys.version_info >= (3, 11):
+            async with asyncio.TaskGroup() as tg:
+                tasks = [tg.create_task(coro) for coro in coros]
+            built = [task.result() for task in tasks]
         else:
-            print(f"[AnalystAgent] The run ended with status={run1.status}, no further steps to do.")
-
-    async def _handle_tool_calls_in_parallel(self, thread_id: str, tool_calls: List):
-        """
-        Parse each function call. We'll run them all concurrently with asyncio.gather,
-        then post each result to the thread.
-        """
-        # 1) Build tasks for each tool call
-        tasks = []
-        call_metas = []  # store (index, call) so we can map results back
-
-        for i, call in enumerate(tool_calls):
-            func_name = call.function.name
-            func_args_str = call.function.arguments
-            args_dict = json.loads(func_args_str)
-
-            # Build a task for each call
-            if func_name == "statcast_query":
-                # We'll run the sql query agent in a separate async method
-                tasks.append(self._run_sql_tool(args_dict))
-                call_metas.append((i, func_name))
-            elif func_name == "visualization_tool":
-                tasks.append(self._run_viz_tool(args_dict))
-                call_metas.append((i, func_name))
-            else:
-                # unrecognized tool
-                tasks.append(asyncio.sleep(0))  # no-op
-                call_metas.append((i, func_name))
-
-        # 2) run them all concurrently
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-
-        # 'results' is a list of same length as tool_calls
-        # each item is either a string (data) or a dict or an image path, etc.
-        # depending on your stubs.
-        # We'll now post them in the same order.
-        for (i, func_name), output in zip(call_metas, results):
-            if isinstance(output, Exception):
-                # handle error
-                content = f"[Tool] Tool {func_name} was not able to be completed at this time"
-                role = "assistant"
-            else:
-                # normal result
-                if func_name == "statcast_query":
-                    # output is a string (like CSV or JSON)
-                    content = f"[Tool] Here is the data from statcast_query tool to help you answer my query:\n"
-                    for out in output: # could be multiple queries
-                        content += f"\n{out['query_description']}:\n{out['data']}"
-                    role = "user"
-                elif func_name == "visualization_tool":
-                    # output is a file_id
-                    content = None
-                    role = "user"
-                else:
-                    content = f"[Tool] Unrecognized tool result: {output}"
-                    role = "user"
-
-            if func_name == "visualization_tool" and not isinstance(output, Exception):
-                # Output will be the image file id, it has already been uploaded
-
-
-                # Here the image was already created in a code_interpreter run, but it does not specify the mime type, which causes an error if you directly use that image id
-                # Because of this, we need to recreate the image with the proper metadata. Dumb but necessary.
-                image_file_id = output
-                #print("imageid: " + image_file_id)
-                file_resp = await self.client.files.content(image_file_id)
-
-                file_bytes = file_resp.read()
-                new_file = io.BytesIO(file_bytes)
-                new_file.name = "visualization.png"
-
-                new_file_resp = await self.client.files.create(
-                    file=new_file,
-                    purpose="vision"
-                )
-                new_file_id = new_file_resp.id
+            built = await asyncio.gather(*coros)
 
-                await self.client.beta.threads.messages.create(
-                    thread_id=thread_id,
-                    role=role,
-                    content=[
-                        {
-                            "type": "text",
-                            "text": "[Tool] Here is the chart from the visualization tool to help you answer my query."
-                        },
-                        {
-                            "type": "image_file",
-                            "image_file": {
-                                "file_id": new_file_id  
-                            }
-                        },
-                    ]
-                )
-            else:
-                # for the SQL data or an error
-                await self.client.beta.threads.messages.create(
-                    thread_id=thread_id,
-                    role=role,
-                    content=content if content else "[Tool] No content (error)"
-                )
+        # 'built' is in the same order as tool_calls
+        tool_outputs = [tool_output for tool_output, _ in built]
+        chart_file_ids = [chart_id for _, chart_id in built if chart_id]
+        return tool_outputs, chart_file_ids
 
-    # Stub or calls to your real local code
-    async def _run_sql_tool(self, args_dict: Dict[str, Any]) -> str:
+    async def _run_and_build(self, call, uploaded_files: Dict[str, str], shared_outputs: Optional[asyncio.Future] = None) -> Tuple[Dict[str, str], Optional[str]]:
         """
-        e.g. local call to your AsyncSQLQueryGeneratorAgent
-        { "query_descriptions": ["Which pitcher had highest release speed?"] }
+        Run one tool call and turn its result into a tool output.
+        :param shared_outputs: optional future of {tool_call_id: output} for calls that were run together
         """
-        query_descs = args_dict["query_descriptions"]
+        func_name = call.function.name
+        if shared_outputs is not None and func_name == "statcast_query":
+            output = (await shared_outputs)[call.id]
+        else:
+            output = await self._run_tool(func_name, call.function.arguments)
+        try:
+            return await self._build_tool_output(call.id, func_name, output, uploaded_files)
+        except Exception:
+            # e.g. a failed upload, don't let it tear down the other tasks in the group
+            return {"tool_call_id": call.id, "output": _ERROR_TEMPLATE.format(name=func_name)}, None
+
+    async def _run_tool(self, func_name: str, func_args_str: str) -> Any:
+        """
+        Parse the arguments and run one tool call.
+        Failures are returned as the exception instead of raised.
+        Unrecognized tools return None.
+        """
+        try:
+            handler = self._tool_handlers.get(func_name)
+            if handler is None:
+                return None
+            return await handler(json_loads(func_args_str))
+        except Exception as e:
+            return e
 
-        res = await self.query_agent.generate_and_run_queries(query_descs)
-        return res
+    async def _run_statcast_calls_together(self, calls: List) -> Dict[str, Any]:
+        """
+        Run the query descriptions of several statcast_query calls with one
+        generate_and_run_queries call and split the results back per call.
+        Like _run_tool, failures are returned as the exception instead of raised.
+        """
+        outputs: Dict[str, Any] = {}
+        descriptions_by_call: Dict[str, List[str]] = {}
+        for call in calls:
+            try:
+                descriptions_by_call[call.id] = json_loads(call.function.arguments)["query_descriptions"]
+            except Exception as e:
+                outputs[call.id] = e
+
+        all_descriptions = [desc for descs in descriptions_by_call.values() for desc in descs]
+        try:
+            results = await self.query_agent.generate_and_run_queries(all_descriptions)
+        except Exception as e:
+            for call_id in descriptions_by_call:
+                outputs[call_id] = e
+            return outputs
+
+        start = 0
+        for call_id, descs in descriptions_by_call.items():
+            outputs[call_id] = results[start:start + len(descs)]
+            start += len(descs)
+        return outputs
+
+    async def _build_tool_output(self, call_id: str, func_name: str, output: Any, uploaded_files: Dict[str, str]) -> Tuple[Dict[str, str], Optional[str]]:
+        """
+        Turn one tool result into a submit_tool_outputs entry.
+        For the visualization tool this also re-uploads the image, returning its new file id.
+        """
+        chart_file_id = None
+        if isinstance(output, Exception):
+            # handle error
+            content = _ERROR_TEMPLATE.format(name=func_name)
+        elif func_name == "statcast_query":
+            # output is a list of query results (CSV or JSON data)
+            datas = await asyncio.gather(*[self._compact_query_data(out['data'], uploaded_files) for out in output])
+            # build the pieces in a list, += on a growing string is quadratic for big CSVs
+            parts = [_STATCAST_PREAMBLE]
+            parts.extend(f"{out['query_description']}:\n{data}" for out, data in zip(output, datas)) # could be multiple queries
+            content = "\n".join(parts)
+        elif func_name == "visualization_tool":
+            # output is the image file id
+            try:
+                chart_file_id = await self._reupload_image(output)
+                content = json.dumps({
+                    "file_id": chart_file_id,
+                    "note": _CHART_NOTE
+                })
+            except Exception:
+                content = _ERROR_TEMPLATE.format(name=func_name)
+        else:
+            content = f"[Tool] Unrecognized tool result: {output}"
+
+        return {"tool_call_id": call_id, "output": content}, chart_file_id
+
+    async def _compact_query_data(self, data: Optional[str], uploaded_files: Dict[str, str]) -> Optional[str]:
+        """
+        Keep big CSV results out of the model's input: upload the full CSV as a file
+        and only put a preview (header + first rows) and the file id in the tool output.
+        The same data within a turn is uploaded once (uploaded_files, digest -> file_id).
+        """
+        if not data or self.query_agent.output_format != "csv":
+            return data
+
+        # Every row ends with a newline, so this is an upper bound on the data rows
+        # (quoted values can hold newlines too), enough to let small results through unparsed
+        if data.count("\n") - 1 <= self.max_inline_rows:
+            return data
+
+        # Parse to get the real row count, and a preview that doesn't cut a quoted value in half
+        reader = csv.reader(io.StringIO(data, newline=""))
+        preview_buf = io.StringIO()
+        writer = csv.writer(preview_buf, lineterminator="\n")
+        for _, row in zip(range(self.max_inline_rows + 1), reader):  # header + max_inline_rows rows
+            writer.writerow(row)
+        total_rows = self.max_inline_rows + sum(1 for _ in reader)
+        if total_rows <= self.max_inline_rows:
+            return data
+
+        digest = hashlib.sha1(data.encode("utf-8")).hexdigest()
+        file_id = uploaded_files.get(digest)
+        if file_id is None:
+            csv_file = io.BytesIO(data.encode("utf-8"))
+            csv_file.name = "query_result.csv"
+            file_resp = await self.client.files.create(file=csv_file, purpose="assistants")
+            file_id = uploaded_files.setdefault(digest, file_resp.id)
+            if file_id != file_resp.id:
+                # an identical result was uploaded concurrently, keep that one
+                await self._delete_file(file_resp.id)
+
+        return (
+            f"(showing the first {self.max_inline_rows} of {total_rows} rows, the full result is "
+            f"attached to this thread as file_id {file_id})\n{preview_buf.getvalue()}"
+        )
 
-    async def _run_viz_tool(self, args_dict: Dict[str, Any]) -> str:
+    async def _attach_files(self, thread_id: str, file_ids: List[str]) -> None:
         """
-        e.g. local call to VisualizationAgent
-        { "visualization_description": "Trend line of homers" }
+        Make the uploaded results available to code interpreter on the thread.
+        The thread's file list is replaced, and only this app attaches files to analyst threads.
         """
-        desc = args_dict["visualization_description"]
-     
-        res = await self.viz_agent.create_visualization(desc)
-        return res #image id
+        await self.client.beta.threads.update(
+            thread_id,
+            tool_resources={"code_interpreter": {"file_ids": file_ids}}
+        )
+
+    async def _discard_uploaded_files(self, thread_id: str, file_ids: List[str]) -> None:
+        """
+        Detach this turn's uploaded results from the thread and delete them, once the run is over.
+        Failures are only logged, the answer is already in the thread.
+        """
+        try:
+            await self.client.beta.threads.update(
+                thread_id,
+                tool_resources={"code_interpreter": {"file_ids": []}}
+            )
+        except Exception as e:
+            print(f"[AnalystAgent] Failed to detach files from thread {thread_id}: {e}")
+        await asyncio.gather(*(self._delete_file(file_id) for file_id in file_ids))
+
+    async def _delete_file(self, file_id: str) -> None:
+        try:
+            await self.client.files.delete(file_id)
+        except Exception as e:
+            print(f"[AnalystAgent] Failed to delete file {file_id}: {e}")
+
+    async def _reupload_image(self, image_file_id: str) -> str:
+        """
+        The image was created in a code_interpreter run, but it does not specify the mime type,
+        which causes an error if you directly use that image id in a message.
+        Because of this, we need to recreate the image with the proper metadata. Dumb but necessary.
+        Re-uploads are cached per image id, and identical concurrent calls share one upload.
+        """
+        return await self._viz_file_cache.get_or_set(
+            image_file_id, lambda: self._download_and_reupload(image_file_id)
+        )
+
+    async def _download_and_reupload(self, image_file_id: str) -> str:
+        new_file = self._get_buf()
+        try:
+            # Stream the download straight into the upload buffer so we only hold one copy
+            async with self.client.files.with_streaming_response.content(image_file_id) as file_resp:
+                async for chunk in file_resp.iter_bytes():
+                    new_file.write(chunk)
+            new_file.seek(0)
+
+            new_file_resp = await self.client.files.create(
+                file=new_file,
+                purpose="vision"
+            )
+            return new_file_resp.id
+        finally:
+            self._return_buf(new_file)
+
+    def _get_buf(self) -> io.BytesIO:
+        """
+        Take an empty upload buffer from the pool (or make a new one).
+        """
+        if self._bytesio_pool:
+            buf = self._bytesio_pool.pop()
+            buf.seek(0)
+            buf.truncate(0)
+            return buf
+        buf = io.BytesIO()
+        buf.name = "visualization.png"  # files.create uses the name to set the mime type
+        return buf
+
+    def _return_buf(self, buf: io.BytesIO) -> None:
+        if len(self._bytesio_pool) < BYTESIO_POOL_SIZE:
+            self._bytesio_pool.append(buf)
+
+    async def _post_chart(self, thread_id: str, file_id: str) -> None:
+        """
+        Post a re-uploaded chart to the thread as a [Tool] message so it reaches the user.
+        """
+        await self.client.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=[
+                {
+                    "type": "text",
+                    "text": _CHART_PREAMBLE
+                },
+                {
+                    "type": "image_file",
+                    "image_file": {
+                        "file_id": file_id
+                    }
+                },
+            ]
+        )
@@ -1,333 +1,123 @@
 import asyncio
+import hashlib
+import json
+import re
+import sys
+import httpx
 import openai
-from typing import List, Dict, Any
-from asyncutils.async_db_query import execute_sql_query_async
-
-
-SQL_SYSTEM_PROMPT = """
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import ParseError
+from collections import deque
+from functools import lru_cache
+from typing import AsyncIterator, Callable, List, Dict, Any, Optional, Tuple, Union
+from cachetools import TTLCache
+
+try:
+    # only used to check once at startup that the prompt is long enough to be cached
+    import tiktoken
+except ImportError:
+    tiktoken = None
+from asyncutils.async_cache import SingleFlightCache
+from Agents.SQLTemplateRouter import TemplateRouter
+from Agents.SemanticCache import SemanticCache
+from asyncutils.async_db_query import (
+    execute_sql_query_async,
+    execute_sql_query_asyncpg,
+    execute_sql_queries_batched_async,
+    execute_sql_queries_batched_asyncpg,
+)
+
+
+# The system prompt is built from static blocks so the long, never-changing parts form
+# one stable prefix (good for prompt caching) and can be maintained separately:
+#   SQL_SCHEMA_PROMPT - the table and its columns
+#   SQL_RULES_PROMPT  - requirements and example queries
+# The per-request description only ever goes in the user message.
+SQL_SCHEMA_PROMPT = """
 You are a helpful Postgres SQL generation assistant with expert knowledge of MLB Baseball. You have access to a Postgres table named `statcast_pitches` 
-in a database containing pitch-level data for all pitches from the 2015-2024 MLB seasons. That is, each entry in the table represents a single pitch and resultant event from an MLB game. The table has the following column names (with short descriptions):
-
-pitch_type (VARCHAR(30))
- - The codified type of pitch derived from Statcast.
- - Possible Values and meanings: 
-    FF or FA: 4-Seam Fastball
-    SI: Sinker/2-Seam Fastball
-    SL: Slider
-    CH: Change-up
-    CU: Curveball
-    FC: Cutter
-    KC: Knuckle-Curve
-    ST: Sweeper
-    FS: Splitter
-    SV: Slurve
-    KN: Knuckleball
-    IN: Intentional Ball
-    EP: Eephus
-    FO: Forkball
-    PO: Pitch Out
-    CS: Slow Curve
-    SC: Screwball
-    AB: Automatic Ball
-
-
-game_date (DATE)
- - Date of the game.
-
-release_speed (FLOAT)
- - Pitch velocity in mph, measured out-of-hand.
-
-release_pos_x (FLOAT)
- - Horizontal Release Position, in feet (catcher’s perspective).
-
-release_pos_z (FLOAT)
- - Vertical Release Position, in feet (catcher’s perspective).
-
-event (VARCHAR(100))
- - The event of the resulting plate appearance (e.g. home_run, strikeout). (NULL when the pitch is not put into play)
- - Possible Values:
-    - field_out
-    - strikeout
-    - single
-    - walk
-    - double
-    - home_run
-    - force_out
-    - grounded_into_double_play
-    - hit_by_pitch
-    - field_error
-    - sac_fly
-    - triple
-    - sac_bunt
-    - double_play
-    - fielders_choice
-    - fielders_choice_out
-    - caught_stealing_2b
-    - intent_walk
-    - strikeout_double_play
-    - catcher_interf
-    - other_out
-    - sac_fly_double_play
-    - caught_stealing_3b
-    - pickoff_1b
-    - caught_stealing_home
-    - wild_pitch
-    - pickoff_2b
-    - triple_play
-
-
-description (VARCHAR(500))
- - The resulting pitch description.
-
-zone (FLOAT)
- - Zone location of the ball when crossing the plate (catcher’s perspective).
- - Possible Values:
-    - 1.0 Through 9.0
-    - 11.0 Through 14.0
-
-des (VARCHAR(500))
- - Plate appearance description from game day.
-
-game_type (VARCHAR(1))
- - Type of Game. E=Exhibition, S=Spring, R=Regular, F=Wild Card, D=Divisional, L=League, W=WorldSeries.
-
-stand (VARCHAR(1))
- - Side of plate batter stands (L/R).
-
-p_throws (VARCHAR(1))
- - Hand pitcher throws with (L/R).
-
-home_team (VARCHAR(10))
- - Abbreviation of home team.
- - Team Abbreviations and Corresponding Team Names:
-    HOU: Houston Astros  
-    NYY: New York Yankees  
-    BOS: Boston Red Sox  
-    PHI: Philadelphia Phillies  
-    LAD: Los Angeles Dodgers  
-    AZ: Arizona Diamondbacks  
-    CHC: Chicago Cubs  
-    MIL: Milwaukee Brewers  
-    MIN: Minnesota Twins  
-    ATL: Atlanta Braves  
-    TOR: Toronto Blue Jays  
-    TEX: Texas Rangers  
-    TB: Tampa Bay Rays  
-    NYM: New York Mets  
-    COL: Colorado Rockies  
-    CIN: Cincinnati Reds  
-    PIT: Pittsburgh Pirates  
-    DET: Detroit Tigers  
-    STL: St. Louis Cardinals  
-    SD: San Diego Padres  
-    CWS: Chicago White Sox  
-    BAL: Baltimore Orioles  
-    WSH: Washington Nationals  
-    MIA: Miami Marlins  
-    LAA: Los Angeles Angels  
-    CLE: Cleveland Guardians  
-    SF: San Francisco Giants  
-    OAK: Oakland Athletics  
-    KC: Kansas City Royals
-
-away_team (VARCHAR(10))
- - Abbreviation of away team.
-
-type (VARCHAR(1))
- - Short result code: B=ball, S=strike, X=in play. When type is 'B' or 'S' the "event" field will be NULL. IMPORTANT: when the event is a strikeout, type will equal S.
-
-hit_location (FLOAT)
- - Position of first fielder to touch the ball. (NULL when event is NULL) (Does not correspond to the position of the current batter, but the position of the player who fields the batted ball)
- - Locations and Corresponding Positions:
-    1.0: Pitcher  
-    2.0: Catcher  
-    3.0: First Baseman  
-    4.0: Second Baseman  
-    5.0: Third Baseman  
-    6.0: Shortstop  
-    7.0: Left Fielder  
-    8.0: Center Fielder  
-    9.0: Right Fielder
-
-bb_type (VARCHAR(30))
- - Batted ball type (ground_ball, line_drive, fly_ball, popup).
-
-balls (INT)
- - Pre-pitch number of balls in count.
-
-strikes (INT)
- - Pre-pitch number of strikes in count.
-
-game_year (INT)
- - Year the game took place.
-
-pfx_x (FLOAT)
- - Horizontal movement in feet (catcher’s perspective).
-
-pfx_z (FLOAT)
- - Vertical movement in feet (catcher’s perspective).
-
-plate_x (FLOAT)
- - Horizontal position crossing home plate (catcher’s perspective).
-
-plate_z (FLOAT)
- - Vertical position crossing home plate (catcher’s perspective).
-
-on_3b (FLOAT)
- - Pre-pitch MLB Player Id of runner on 3B.
-
-on_2b (FLOAT)
- - Pre-pitch MLB Player Id of runner on 2B.
-
-on_1b (FLOAT)
- - Pre-pitch MLB Player Id of runner on 1B.
-
-outs_when_up (INT)
- - Pre-pitch number of outs.
-
-inning (INT)
- - Pre-pitch inning number.
-
-inning_topbot (VARCHAR(3))
- - Indicates whether top or bottom of inning (Top/Bot).
-
-hc_x (FLOAT)
- - Hit coordinate X of batted ball.
-
-hc_y (FLOAT)
- - Hit coordinate Y of batted ball.
-
-
-sv_id (VARCHAR(50))
- - Non-unique Id of play event per game.
-
-vx0 (FLOAT)
- - Velocity in ft/s, x-dimension at y=50 ft.
-
-vy0 (FLOAT)
- - Velocity in ft/s, y-dimension at y=50 ft.
-
-vz0 (FLOAT)
- - Velocity in ft/s, z-dimension at y=50 ft.
-
-ax (FLOAT)
- - Acceleration in ft/s², x-dimension at y=50 ft.
-
-ay (FLOAT)
- - Acceleration in ft/s², y-dimension at y=50 ft.
-
-az (FLOAT)
- - Acceleration in ft/s², z-dimension at y=50 ft.
-
-sz_top (FLOAT)
- - Top of batter’s strike zone in mid-flight.
-
-sz_bot (FLOAT)
- - Bottom of batter’s strike zone in mid-flight.
-
-hit_distance_sc (FLOAT)
- - Projected hit distance of batted ball.
-
-launch_speed (FLOAT)
- - Exit velocity of batted ball (Statcast).
-
-launch_angle (FLOAT)
- - Launch angle of batted ball (Statcast).
-
-effective_speed (FLOAT)
- - Derived pitch speed factoring release extension.
-
-release_spin_rate (FLOAT)
- - Spin rate of the pitch (Statcast).
-
-release_extension (FLOAT)
- - Pitcher’s release extension in feet (Statcast).
-
-game_pk (INT)
- - Unique game Id.
-
-release_pos_y (FLOAT)
- - Release position in feet (y-dimension, catcher’s perspective).
-
-estimated_ba_using_speedangle (FLOAT)
- - Estimated batting avg using exit velocity & launch angle.
-
-estimated_woba_using_speedangle (FLOAT)
- - Estimated wOBA using exit velocity & launch angle.
-
-woba_value (FLOAT)
- - wOBA value based on the result.
-
-woba_denom (FLOAT)
- - wOBA denominator.
-
-babip_value (FLOAT)
- - BABIP value for the result.
-
-iso_value (FLOAT)
- - ISO value for the result of the play.
-
-launch_speed_angle (FLOAT)
- - Launch speed/angle zone code (1=Weak, 2=Topped, 3=Under, 4=Flare/Burner, 5=Solid, 6=Barrel).
-
-at_bat_number (INT)
- - Plate appearance number in the game.
-
-pitch_number (INT)
- - Pitch number in the plate appearance.
-
-pitch_name (VARCHAR(50))
- - Name of pitch (Statcast classification).
-
-home_score (INT)
- - Pre-pitch home score.
-
-away_score (INT)
- - Pre-pitch away score.
-
-bat_score (INT)
- - Pre-pitch batting team score.
-
-fld_score (INT)
- - Pre-pitch fielding team score.
-
-post_home_score (INT)
- - Post-pitch home score.
-
-post_away_score (INT)
- - Post-pitch away score.
-
-post_bat_score (INT)
- - Post-pitch batting team score.
-
-if_fielding_alignment (VARCHAR(50))
- - Infield fielding alignment at pitch time. (Standard, Infield shift, Infield shade, Strategic)
-
-of_fielding_alignment (VARCHAR(50))
- - Outfield fielding alignment at pitch time. (Standard, Strategic, 4th outfielder, Extreme outfield shift)
-
-spin_axis (FLOAT)
- - Spin Axis in 2D X-Z plane (degrees).
-
-delta_home_win_exp (FLOAT)
- - Change in home team Win Expectancy from pre to post event.
-
-delta_run_exp (FLOAT)
- - Change in Run Expectancy from pre to post pitch.
-
-bat_speed (FLOAT)
- - (Custom) measured or estimated bat speed.
-
-swing_length (FLOAT)
- - (Custom) measured or estimated swing length.
-
-batter_name (VARCHAR(100))
- - The batter's name. (first last) (all lowercase)
-
-pitcher_name (VARCHAR(100))
- - The pitcher's name. (first last) (all lowercase)
-
-IMPORTANT REQUIREMENTS:
+in a database containing pitch-level data for all pitches from the 2015-2024 MLB seasons. That is, each entry in the table represents a single pitch and resultant event from an MLB game.
+Columns, one per line as `name:TYPE # description` (positions are from the catcher's perspective, {a|b} lists the possible values):
+
+pitch_type:VARCHAR(30) # Statcast pitch type {FF|FA=4-Seam Fastball|SI=Sinker/2-Seam Fastball|SL=Slider|CH=Change-up|CU=Curveball|FC=Cutter|KC=Knuckle-Curve|ST=Sweeper|FS=Splitter|SV=Slurve|KN=Knuckleball|IN=Intentional Ball|EP=Eephus|FO=Forkball|PO=Pitch Out|CS=Slow Curve|SC=Screwball|AB=Automatic Ball}
+game_date:DATE # date of the game
+release_speed:FLOAT # pitch velocity in mph, out-of-hand
+release_pos_x:FLOAT # horizontal release position, ft
+release_pos_z:FLOAT # vertical release position, ft
+event:VARCHAR(100) # result of the plate appearance, NULL when the pitch is not put into play {field_out|strikeout|single|walk|double|home_run|force_out|grounded_into_double_play|hit_by_pitch|field_error|sac_fly|triple|sac_bunt|double_play|fielders_choice|fielders_choice_out|caught_stealing_2b|intent_walk|strikeout_double_play|catcher_interf|other_out|sac_fly_double_play|caught_stealing_3b|pickoff_1b|caught_stealing_home|wild_pitch|pickoff_2b|triple_play}
+description:VARCHAR(500) # resulting pitch description
+zone:FLOAT # zone of the ball crossing the plate {1.0-9.0|11.0-14.0}
+des:VARCHAR(500) # plate appearance description from game day
+game_type:VARCHAR(1) # {E=Exhibition|S=Spring|R=Regular|F=Wild Card|D=Divisional|L=League|W=WorldSeries}
+stand:VARCHAR(1) # side of plate the batter stands {L|R}
+p_throws:VARCHAR(1) # hand the pitcher throws with {L|R}
+home_team:VARCHAR(10) # home team abbreviation {HOU=Houston Astros|NYY=New York Yankees|BOS=Boston Red Sox|PHI=Philadelphia Phillies|LAD=Los Angeles Dodgers|AZ=Arizona Diamondbacks|CHC=Chicago Cubs|MIL=Milwaukee Brewers|MIN=Minnesota Twins|ATL=Atlanta Braves|TOR=Toronto Blue Jays|TEX=Texas Rangers|TB=Tampa Bay Rays|NYM=New York Mets|COL=Colorado Rockies|CIN=Cincinnati Reds|PIT=Pittsburgh Pirates|DET=Detroit Tigers|STL=St. Louis Cardinals|SD=San Diego Padres|CWS=Chicago White Sox|BAL=Baltimore Orioles|WSH=Washington Nationals|MIA=Miami Marlins|LAA=Los Angeles Angels|CLE=Cleveland Guardians|SF=San Francisco Giants|OAK=Oakland Athletics|KC=Kansas City Royals}
+away_team:VARCHAR(10) # away team abbreviation, same values as home_team
+type:VARCHAR(1) # short result {B=ball|S=strike|X=in play}; event is NULL when type is B or S. IMPORTANT: a strikeout event has type S
+hit_location:FLOAT # position of the first fielder to touch the batted ball (not the batter's position), NULL when event is NULL {1.0=Pitcher|2.0=Catcher|3.0=First Baseman|4.0=Second Baseman|5.0=Third Baseman|6.0=Shortstop|7.0=Left Fielder|8.0=Center Fielder|9.0=Right Fielder}
+bb_type:VARCHAR(30) # batted ball type {ground_ball|line_drive|fly_ball|popup}
+balls:INT # pre-pitch balls in count
+strikes:INT # pre-pitch strikes in count
+game_year:INT # year of the game
+pfx_x:FLOAT # horizontal movement, ft
+pfx_z:FLOAT # vertical movement, ft
+plate_x:FLOAT # horizontal position crossing home plate
+plate_z:FLOAT # vertical position crossing home plate
+on_3b:FLOAT # pre-pitch MLB player id of runner on 3B
+on_2b:FLOAT # pre-pitch MLB player id of runner on 2B
+on_1b:FLOAT # pre-pitch MLB player id of runner on 1B
+outs_when_up:INT # pre-pitch outs
+inning:INT # pre-pitch inning
+inning_topbot:VARCHAR(3) # {Top|Bot}
+hc_x:FLOAT # hit coordinate X of batted ball
+hc_y:FLOAT # hit coordinate Y of batted ball
+sv_id:VARCHAR(50) # non-unique id of play event per game
+vx0:FLOAT # velocity ft/s, x at y=50 ft
+vy0:FLOAT # velocity ft/s, y at y=50 ft
+vz0:FLOAT # velocity ft/s, z at y=50 ft
+ax:FLOAT # acceleration ft/s², x at y=50 ft
+ay:FLOAT # acceleration ft/s², y at y=50 ft
+az:FLOAT # acceleration ft/s², z at y=50 ft
+sz_top:FLOAT # top of batter's strike zone in mid-flight
+sz_bot:FLOAT # bottom of batter's strike zone in mid-flight
+hit_distance_sc:FLOAT # projected hit distance of batted ball
+launch_speed:FLOAT # exit velocity of batted ball
+launch_angle:FLOAT # launch angle of batted ball
+effective_speed:FLOAT # pitch speed adjusted for release extension
+release_spin_rate:FLOAT # spin rate of the pitch
+release_extension:FLOAT # pitcher's release extension, ft
+game_pk:INT # unique game id
+release_pos_y:FLOAT # release position, ft (y-dimension)
+estimated_ba_using_speedangle:FLOAT # estimated batting avg from exit velocity & launch angle
+estimated_woba_using_speedangle:FLOAT # estimated wOBA from exit velocity & launch angle
+woba_value:FLOAT # wOBA value of the result
+woba_denom:FLOAT # wOBA denominator
+babip_value:FLOAT # BABIP value of the result
+iso_value:FLOAT # ISO value of the result
+launch_speed_angle:FLOAT # {1=Weak|2=Topped|3=Under|4=Flare/Burner|5=Solid|6=Barrel}
+at_bat_number:INT # plate appearance number in the game
+pitch_number:INT # pitch number in the plate appearance
+pitch_name:VARCHAR(50) # Statcast pitch name
+home_score:INT # pre-pitch home score
+away_score:INT # pre-pitch away score
+bat_score:INT # pre-pitch batting team score
+fld_score:INT # pre-pitch fielding team score
+post_home_score:INT # post-pitch home score
+post_away_score:INT # post-pitch away score
+post_bat_score:INT # post-pitch batting team score
+if_fielding_alignment:VARCHAR(50) # {Standard|Infield shift|Infield shade|Strategic}
+of_fielding_alignment:VARCHAR(50) # {Standard|Strategic|4th outfielder|Extreme outfield shift}
+spin_axis:FLOAT # spin axis in the 2D X-Z plane, degrees
+delta_home_win_exp:FLOAT # change in home team win expectancy, pre to post event
+delta_run_exp:FLOAT # change in run expectancy, pre to post pitch
+bat_speed:FLOAT # measured or estimated bat speed
+swing_length:FLOAT # measured or estimated swing length
+batter_name:VARCHAR(100) # batter's name, "first last", all lowercase
+pitcher_name:VARCHAR(100) # pitcher's name, "first last", all lowercase
+
+"""
+
+SQL_RULES_PROMPT = """IMPORTANT REQUIREMENTS:
 1) All queries MUST be read-only SELECT statements.
 2) Do NOT include semicolons or multiple statements.
 3) Only output the valid Postgres SQL statement, nothing else (no English explanation).
@@ -529,64 +319,362 @@ involving stats like BA, OBP, ERA, team-wide hitting stats, etc.
 Always return only the single SELECT statement needed for the user’s request, with no extra text or formatting.
 """ 
 
-async def generate_sql_async(client, description: str, system_prompt: str, model_name: str = "gpt-4o", temperature: float = 0.0):
+SQL_SYSTEM_PROMPT = SQL_SCHEMA_PROMPT + SQL_RULES_PROMPT
+
+# Stripped once at import instead of on every call
+SQL_SYSTEM_PROMPT_STRIPPED = SQL_SYSTEM_PROMPT.strip()
+
+# Built once so every call sends a bit-identical prompt prefix, which is what
+# OpenAI's automatic prompt caching matches on.
+_SQL_SYSTEM_MESSAGE = {"role": "system", "content": SQL_SYSTEM_PROMPT_STRIPPED}
+
+# Stable end-user id sent with every request so they get routed to the same prompt cache
+PROMPT_CACHE_USER = "statcast-sql-agent"
+
+# Ask for token usage at the end of streamed completions, to see how much of the prompt was cached
+_STREAM_OPTIONS = {"include_usage": True}
+
+# OpenAI only caches prompts of at least this many tokens
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+# Number of recent completions the prompt cache hit rate is computed over
+PROMPT_CACHE_WINDOW = 50
+
+
+# What each model accepts, models not listed here accept everything
+_ALL_CAPS = {"system_role": True, "temperature": True, "response_format": True}
+_REASONING_CAPS = {"system_role": True, "temperature": False, "response_format": True}
+MODEL_CAPS = {
+    "o1-mini": {"system_role": False, "temperature": False, "response_format": False},
+    "o1-preview": {"system_role": False, "temperature": False, "response_format": False},
+    # reasoning models only run at their default temperature
+    "o1": _REASONING_CAPS,
+    "o3": _REASONING_CAPS,
+    "o3-mini": _REASONING_CAPS,
+    "o3-pro": _REASONING_CAPS,
+    "o4-mini": _REASONING_CAPS,
+}
+
+# dated snapshots ("o3-mini-2025-01-31") have the caps of their base model
+_MODEL_SNAPSHOT_SUFFIX = re.compile(r"-\d{4}-\d{2}-\d{2}$")
+
+
+def model_caps(model_name: str) -> Dict[str, bool]:
     """
-    Calls OpenAI's Chat Completions endpoint in async mode to generate a single SQL query.
+    What the model accepts (see MODEL_CAPS), shared with SQLQueryGeneratorAgent.
     """
+    caps = MODEL_CAPS.get(model_name)
+    if caps is None:
+        caps = MODEL_CAPS.get(_MODEL_SNAPSHOT_SUFFIX.sub("", model_name), _ALL_CAPS)
+    return caps
 
-    
-    if model_name == "o1-mini":
 
-        messages=[
+def _completion_kwargs(model_name: str, system_prompt: str, request: str, temperature: float) -> Dict[str, Any]:
+    """
+    Chat Completions arguments for one request, shaped for what the model accepts.
+    The system prompt always comes first and is bit-identical across calls, either as the
+    system message or, for models that reject the system role, as the first content block
+    of the user message, so it stays a cacheable prefix.
+    """
+    caps = model_caps(model_name)
+    system_message = _system_message(system_prompt)
+
+    if caps["system_role"]:
+        messages = [system_message, {"role": "user", "content": request}]
+    else:
+        messages = [
             {
                 "role": "user",
                 "content": [
-                    {
-                        "type": "text",
-                        "text": f" {system_prompt.strip()}   Generate a read-only SQL query for: '{description}'"
-                    },
+                    {"type": "text", "text": system_message["content"]},
+                    {"type": "text", "text": request},
                 ],
             }
         ]
 
-        response = await client.chat.completions.create(
-            model=model_name,
-            messages=messages
-        )
-        
-    else:
+    kwargs = {"model": model_name, "messages": messages, "user": PROMPT_CACHE_USER}
+    if caps["temperature"]:
+        kwargs["temperature"] = temperature
+    return kwargs
 
-        messages = [
-            {"role": "system", "content": system_prompt.strip()},
-            {
-                "role": "user",
-                "content": f"Generate a read-only SQL query for: '{description}'"
-            }
-        ]
 
+def _system_message(system_prompt: str) -> Dict[str, str]:
+    """
+    The system message for `system_prompt`, reusing the prebuilt one for the default prompt.
+    """
+    if system_prompt is SQL_SYSTEM_PROMPT or system_prompt is SQL_SYSTEM_PROMPT_STRIPPED:
+        return _SQL_SYSTEM_MESSAGE
+    return _custom_system_message(system_prompt)
+
+
+@lru_cache(maxsize=8)
+def _custom_system_message(system_prompt: str) -> Dict[str, str]:
+    # memoized so custom prompts are also only stripped once (callers must not mutate the dict)
+    return {"role": "system", "content": system_prompt.strip()}
+
+
+async def generate_sql_stream_async(client, description: str, system_prompt: str, model_name: str = "gpt-4o", temperature: float = 0.0, on_usage: Optional[Callable[[Any], None]] = None) -> AsyncIterator[str]:
+    """
+    Calls OpenAI's Chat Completions endpoint in streaming mode and yields the SQL text
+    as it arrives, so interactive callers can show the query while it is being written.
+    Raises ValueError as soon as the model starts answering with something other than a query.
+    Note the yielded text may still include the ``` fence, see strip_code_fences.
+    on_usage, if given, is called with the token usage once the stream is done.
+    """
+
+    stream = await client.chat.completions.create(
+        **_completion_kwargs(model_name, system_prompt, f"Generate a read-only SQL query for: '{description}'", temperature),
+        stream=True,
+        stream_options=_STREAM_OPTIONS
+    )
+
+    looks_like_sql = None
+    head_parts: List[str] = []
+    async for chunk in stream:
+        if not chunk.choices:
+            # the last chunk has no choices, only the usage
+            if chunk.usage is not None and on_usage is not None:
+                on_usage(chunk.usage)
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+
+        if looks_like_sql is None:
+            # hold deltas back until we can tell whether this is a query at all
+            head_parts.append(delta)
+            head_text = "".join(head_parts)
+            looks_like_sql = starts_like_sql(head_text.lstrip())
+            if looks_like_sql is False:
+                await stream.close()
+                raise ValueError(f"Model did not return a SQL query: {head_text[:100]!r}")
+            if looks_like_sql:
+                yield head_text
+            continue
+
+        yield delta
+
+    if looks_like_sql is None and head_parts:
+        # too short to tell, hand it over as is
+        yield "".join(head_parts)
+
+
+async def generate_sql_async(client, description: str, system_prompt: str, model_name: str = "gpt-4o", temperature: float = 0.0, on_usage: Optional[Callable[[Any], None]] = None):
+    """
+    Calls OpenAI's Chat Completions endpoint in async mode to generate a single SQL query.
+    The completion is streamed, so we can give up as soon as the model starts answering
+    with something other than a query instead of waiting for the whole explanation.
+    The query is only returned once complete, since running a half-written query
+    could silently return the wrong rows (e.g. before its WHERE or LIMIT arrives).
+    """
+    parts: List[str] = []
+    async for delta in generate_sql_stream_async(client, description, system_prompt, model_name, temperature, on_usage):
+        parts.append(delta)
+
+    sql_code = "".join(parts).strip()
+
+    return strip_trailing_semicolons(strip_code_fences(sql_code))
+
+
+# What the start of a generated query should look like, once any opening fence is skipped
+_SQL_START = re.compile(r"\(?\s*(select|with)\b", re.IGNORECASE)
+
+
+def starts_like_sql(head: str) -> Optional[bool]:
+    """
+    Check the first streamed characters of a completion.
+    Returns None while there isn't enough text to tell yet.
+    """
+    if head.startswith("```"):
+        newline = head.find("\n")
+        if newline == -1:
+            return None
+        head = head[newline + 1:].lstrip()
+    if len(head) < 7:
+        return None
+    return bool(_SQL_START.match(head))
 
-        response = await client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            temperature=temperature
-        )
 
+async def generate_sql_batch_async(client, descriptions: List[str], system_prompt: str, model_name: str = "gpt-4o", temperature: float = 0.0, on_usage: Optional[Callable[[Any], None]] = None) -> List[str]:
+    """
+    Generates one SQL query per description with a single Chat Completions call,
+    so the large system prompt is only sent (and billed) once for the whole batch.
+    Raises ValueError if the model does not return exactly one query per description.
+    """
+    numbered = "\n".join(f"{i}) '{desc}'" for i, desc in enumerate(descriptions, start=1))
+    request = (
+        "Generate a read-only SQL query for each of the following descriptions. "
+        'Return a JSON object of the form {"queries": ["<sql for 1>", "<sql for 2>", ...]} '
+        "with exactly one query per description, in the same order, and nothing else:\n"
+        f"{numbered}"
+    )
+
+    kwargs = _completion_kwargs(model_name, system_prompt, request, temperature)
+    # models without response_format still get asked for JSON, we just parse whatever comes back
+    if model_caps(model_name)["response_format"]:
+        kwargs["response_format"] = {"type": "json_object"}
+    response = await client.chat.completions.create(**kwargs)
+
+    if response.usage is not None and on_usage is not None:
+        on_usage(response.usage)
+
+    content = strip_code_fences(response.choices[0].message.content.strip())
+    parsed = json.loads(content)
+    queries = parsed.get("queries") if isinstance(parsed, dict) else parsed
+
+    if (
+        not isinstance(queries, list)
+        or len(queries) != len(descriptions)
+        or not all(isinstance(q, str) and q.strip() for q in queries)
+    ):
+        raise ValueError(f"Expected {len(descriptions)} queries from batched generation, got: {content[:200]}")
+
+    return [strip_trailing_semicolons(strip_code_fences(q.strip())) for q in queries]
+
+
+# A fenced block (```sql ... ```, ```json ... ``` or bare ```), capturing the body
+_FENCE = re.compile(r"^\s*```(?:[a-z]*[ \t]*\r?\n)?\s*(.*?)\s*```\s*$", re.DOTALL | re.IGNORECASE)
+
+
+def strip_code_fences(sql_code: str) -> str:
+    """
+    Remove markdown code fences the model sometimes wraps around its answer.
+    Only the fence itself is removed, so "sql" inside the query is left alone.
+    """
+    m = _FENCE.match(sql_code)
+    return m.group(1) if m else sql_code
+
+
+def strip_trailing_semicolons(sql: str) -> str:
+    """
+    Drop the trailing ; the model sometimes adds despite the prompt, so the statement
+    can be validated as-is and embedded in a batched query.
+    """
+    return sql.rstrip().rstrip(";").rstrip()
+
+
+# Punctuation that doesn't change what is being asked (a "." is kept inside numbers like 3.5)
+_IGNORED_PUNCTUATION = re.compile(r"[?!,;:\"'`]|\.(?!\d)")
+
+
+def normalize_description(description: str) -> str:
+    """
+    Normalize a query description for cache lookups: lowercase, drop punctuation
+    that doesn't change the meaning, and collapse whitespace.
+    """
+    return " ".join(_IGNORED_PUNCTUATION.sub(" ", description.lower()).split())
+
+
+class SQLValidationError(ValueError):
+    """
+    Raised when generated SQL is not a single, parseable, read-only SELECT.
+    """
+
+
+# Statement roots we accept (WITH ... SELECT parses as a Select)
+_READ_ONLY_ROOTS = (exp.Select, exp.Union, exp.Intersect, exp.Except)
 
+# Nodes that must not appear anywhere in the tree (names vary a little across sqlglot versions).
+# Into is SELECT ... INTO (creates a table), Lock is FOR UPDATE / FOR SHARE (takes row locks).
+_WRITE_NODES = tuple(
+    getattr(exp, name)
+    for name in (
+        "Insert", "Update", "Delete", "Merge", "Create", "Drop", "Alter", "AlterTable", "TruncateTable", "Command",
+        "Into", "Lock"
+    )
+    if hasattr(exp, name)
+)
 
-    sql_code = response.choices[0].message.content.strip()
 
-    # remove code fences if needed
-    if sql_code.startswith("```"):
-        sql_code = sql_code.strip("```").replace("sql\n", "").replace("sql", "")
-    
+@lru_cache(maxsize=1024)
+def parse_sql(sql: str) -> Tuple[exp.Expression, ...]:
+    """
+    Parse SQL into its statement trees, cached by SQL text since cached and template
+    queries come back over and over. The trees are shared, callers must not modify them.
+    Raises sqlglot's ParseError (failures aren't cached).
+    """
+    return tuple(stmt for stmt in sqlglot.parse(sql, read="postgres") if stmt is not None)
+
+
+def validate_select_sql(sql: str) -> None:
+    """
+    Parse the generated SQL locally and make sure it is exactly one read-only SELECT,
+    so malformed or writing statements never cost a DB round-trip.
+    Raises SQLValidationError otherwise.
+    """
+    try:
+        statements = parse_sql(sql)
+    except ParseError as e:
+        raise SQLValidationError(f"Generated SQL could not be parsed: {str(e).splitlines()[0]}") from e
+
+    if len(statements) != 1:
+        raise SQLValidationError(f"Expected exactly one SQL statement, got {len(statements)}")
+
+    tree = statements[0]
+    # "(SELECT ...)" parses as a Subquery around the SELECT, check what is inside the parentheses
+    root = tree
+    while isinstance(root, (exp.Subquery, exp.Paren)):
+        root = root.this
+    if not isinstance(root, _READ_ONLY_ROOTS):
+        raise SQLValidationError(f"Only SELECT queries are allowed, got {root.key.upper()}")
+
+    # the whole statement, e.g. "(SELECT ...) FOR UPDATE" puts the lock outside the parentheses
+    write_node = tree.find(*_WRITE_NODES)
+    if write_node is not None:
+        raise SQLValidationError(f"Only read-only queries are allowed, found {write_node.key.upper()}")
+
+
+# OpenAI errors that no other query in the batch would get past either
+FATAL_OPENAI_ERRORS = (openai.AuthenticationError, openai.PermissionDeniedError)
+
+
+# Results with at most this many rows (by LIMIT) are small enough to batch into one round-trip
+BATCHABLE_LIMIT = 1000
 
-    return sql_code
+
+def is_small_result_sql(sql: str) -> bool:
+    """
+    Guess from the AST whether a validated SELECT returns a small result:
+    either it has a LIMIT of at most BATCHABLE_LIMIT, or it aggregates without a GROUP BY.
+    """
+    try:
+        statements = parse_sql(sql)
+    except ParseError:
+        return False
+    if len(statements) != 1 or not isinstance(statements[0], exp.Select):
+        return False
+    tree = statements[0]
+
+    limit = tree.args.get("limit")
+    if limit is not None:
+        count = limit.expression
+        return isinstance(count, exp.Literal) and count.is_int and int(count.name) <= BATCHABLE_LIMIT
+
+    if tree.args.get("group") is None:
+        return any(isinstance(e.unalias(), exp.AggFunc) for e in tree.expressions)
+    return False
+
+
+@lru_cache(maxsize=1)
+def default_openai_client() -> openai.AsyncOpenAI:
+    """
+    The process-wide AsyncOpenAI client used by agents that weren't given one.
+    Created on first use and shared, so every agent reuses the same HTTP/2 keep-alive pool
+    instead of paying a TLS handshake per client.
+    """
+    return openai.AsyncOpenAI(
+        http_client=httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(120.0, connect=5.0),
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+        )
+    )
 
 
 class AsyncSQLQueryGeneratorAgent:
     """
     An asynchronous SQL Query Generator Agent:
-     1) calls OpenAI Chat Completions in async,
+     1) calls OpenAI Chat Completions in async (one batched call for multiple descriptions),
      2) executes queries on your Cloud SQL instance in async,
      3) parallelizes multiple queries using asyncio.gather.
     """
@@ -594,81 +682,507 @@ class AsyncSQLQueryGeneratorAgent:
     def __init__(
         self,
         engine,              # AsyncEngine
-        client,
+        client=None,         # AsyncOpenAI
         openai_model: str = "gpt-4o",
         temperature: float = 0.0,
-        system_prompt: str = SQL_SYSTEM_PROMPT,
-        output_format: str = 'csv'
+        system_prompt: str = SQL_SYSTEM_PROMPT_STRIPPED,
+        output_format: str = 'csv',
+        db_concurrency: int = 10,
+        llm_concurrency: int = 8,
+        sql_cache_size: int = 1024,
+        sql_cache_ttl: float = 3600,
+        result_cache_size: int = 1024,
+        result_cache_ttl: float = 600,
+        db_pool=None,        # asyncpg.Pool
+        use_templates: bool = True,
+        cheap_model: Optional[str] = None,
+        semantic_cache: Optional[SemanticCache] = None,
+        sql_result_cache_bytes: int = 64 * 1024 * 1024,
+        sql_result_cache_ttl: float = 3600
     ):
         """
         :param engine: an async SQLAlchemy engine (from get_async_engine)
+        :param client: the AsyncOpenAI client. Share one client across the whole process so requests
+                       reuse its keep-alive connections. If None, a process-wide HTTP/2 client is used.
         :param openai_model: e.g. "gpt-4"
         :param temperature: LLM temperature
         :param system_prompt: the schema/instructions prompt
+        :param db_concurrency: max queries running at once, should match the engine's pool_size
+        :param llm_concurrency: max Chat Completions requests in flight at once
+        :param sql_cache_size: how many generated queries to remember per description
+        :param sql_cache_ttl: seconds a remembered query stays valid
+        :param result_cache_size: how many full results (SQL + data) to remember per description
+        :param result_cache_ttl: seconds a remembered result stays valid
+        :param db_pool: optional raw asyncpg pool (from get_asyncpg_pool), used instead of the engine when given
+        :param use_templates: answer plain BA/OBP/ERA/team BA requests with template SQL instead of the LLM
+        :param cheap_model: optional smaller model (e.g. "gpt-4o-mini") that drafts single queries first,
+                            openai_model only gets called when the draft fails to validate or run
+        :param semantic_cache: optional SemanticCache, reuses the SQL of earlier similar (paraphrased)
+                               descriptions instead of generating it again
+        :param sql_result_cache_bytes: total size of the query results kept per exact SQL text
+        :param sql_result_cache_ttl: seconds a result stays valid for the same SQL
         """
         self.engine = engine
-        self.client = client
+        # Same pool, but asyncpg skips the BEGIN (and the ROLLBACK on checkin) around each
+        # statement, one round-trip less for the read-only queries. Streaming (json) still goes
+        # through self.engine, asyncpg only opens server-side cursors inside a transaction.
+        self._autocommit_engine = (
+            engine.execution_options(isolation_level="AUTOCOMMIT") if engine is not None else None
+        )
+        self.db_pool = db_pool
+        self.client = client if client is not None else default_openai_client()
         self.openai_model = openai_model
+        self.cheap_model = cheap_model
         self.temperature = temperature
         self.system_prompt = system_prompt or "..."
         self.output_format = output_format
+        # keeps a large gather from queueing on (or timing out against) the connection pool
+        self._db_sem = asyncio.Semaphore(db_concurrency)
+        # bursts of parallel completions trigger 429s whose backoff is slower than just waiting
+        self._llm_sem = asyncio.Semaphore(llm_concurrency)
+        # (description hash, model, temperature) -> SQL that ran successfully.
+        # Only the SQL is cached, the data is always fetched fresh.
+        self._sql_cache = TTLCache(maxsize=sql_cache_size, ttl=sql_cache_ttl)
+        self.template_router = TemplateRouter() if use_templates else None
+        self.semantic_cache = semantic_cache
+        # (model, temperature, normalized description) -> full result, for repeats within a few minutes.
+        # Concurrent identical descriptions share one LLM call + query, and failed results aren't kept.
+        self._result_cache = SingleFlightCache(
+            TTLCache(maxsize=result_cache_size, ttl=result_cache_ttl),
+            should_cache=lambda res: res.get("error") is None
+        )
+        # (SQL regenerated from its parse tree, output_format) -> data. The statcast data is historical,
+        # so the same SQL returns the same rows, whichever description produced it. Sized by len(data),
+        # results over an eighth of the budget aren't kept.
+        self._sql_result_cache = SingleFlightCache(
+            TTLCache(maxsize=sql_result_cache_bytes, ttl=sql_result_cache_ttl, getsizeof=len),
+            should_cache=lambda data: len(data) <= sql_result_cache_bytes // 8
+        )
+        # (cached_tokens, prompt_tokens) of the last completions, to catch prompt cache regressions
+        self._prompt_cache_window = deque(maxlen=PROMPT_CACHE_WINDOW)
+        self._prompt_cache_calls = 0
+        self._check_system_prompt()
 
-    async def generate_and_run_queries(self, query_descriptions: List[str]) -> List[Dict[str, Any]]:
+    def _check_system_prompt(self) -> None:
         """
-        Kick off tasks for each query in parallel, gather results.
+        Log a fingerprint of the system prompt, so a change that breaks prompt caching
+        (even whitespace) shows up in the logs, and warn if it is too short to be cached at all.
         """
-        tasks = []
-        for desc in query_descriptions:
-            tasks.append(self._handle_one_query(desc))
+        prompt_sha = hashlib.sha256(_system_message(self.system_prompt)["content"].encode("utf-8")).hexdigest()[:12]
+        print(f"[AsyncSQLQueryGeneratorAgent] system prompt sha256={prompt_sha}")
+
+        if tiktoken is not None:
+            try:
+                encoding = tiktoken.encoding_for_model(self.openai_model)
+            except KeyError:
+                encoding = tiktoken.get_encoding("o200k_base")
+            n_tokens = len(encoding.encode(_system_message(self.system_prompt)["content"]))
+            if n_tokens < PROMPT_CACHE_MIN_TOKENS:
+                print(f"[AsyncSQLQueryGeneratorAgent] WARNING: system prompt is {n_tokens} tokens, "
+                      f"below the {PROMPT_CACHE_MIN_TOKENS} needed for prompt caching")
+
+    def _record_usage(self, usage) -> None:
+        """
+        Track how much of each prompt was served from OpenAI's prompt cache and warn
+        when the hit rate over the last PROMPT_CACHE_WINDOW completions drops below half.
+        """
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        self._prompt_cache_window.append((cached_tokens, usage.prompt_tokens or 0))
+
+        # check once per full window, not on every call
+        self._prompt_cache_calls += 1
+        if self._prompt_cache_calls % PROMPT_CACHE_WINDOW:
+            return
+        cached = sum(c for c, _ in self._prompt_cache_window)
+        total = sum(t for _, t in self._prompt_cache_window)
+        hit_rate = cached / total if total else 0.0
+        print(f"[AsyncSQLQueryGeneratorAgent] prompt cache hit rate over the last {PROMPT_CACHE_WINDOW} calls: {hit_rate:.0%}")
+        if hit_rate < 0.5:
+            print("[AsyncSQLQueryGeneratorAgent] WARNING: prompt cache hit rate is below 50%, check that the prompt prefix is stable")
+
+    async def generate_and_run_queries(
+        self,
+        query_descriptions: List[str],
+        output_format: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Generate the SQL for all descriptions (in one batched LLM call when there are several),
+        then kick off tasks for each query in parallel and gather results.
+        Repeated descriptions are only generated and run once.
 
-        # gather them in parallel
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        :param output_format: overrides self.output_format for this call, e.g. "csv_bytes"
+                              when the data is going to be uploaded as a file
+        """
+        output_format = output_format or self.output_format
+        # dict keeps the first-seen order, so results can be fanned back out by description
+        unique = list(dict.fromkeys(query_descriptions))
+
+        # the common single-query case doesn't need a task group at all
+        if len(unique) == 1:
+            res = await self._handle_one_query_or_error(unique[0], output_format=output_format)
+            return [res] + [dict(res) for _ in query_descriptions[1:]]
+
+        # only the descriptions we have neither a recent result nor recent SQL for go to the LLM
+        sqls: List[Optional[str]] = [self._known_sql(desc) for desc in unique]
+        missing = [
+            i for i, sql in enumerate(sqls)
+            if sql is None and self._result_cache_key(unique[i], output_format) not in self._result_cache.cache
+        ]
+        if missing and self.semantic_cache is not None:
+            similar = await asyncio.gather(*(self._similar_sql(unique[i]) for i in missing))
+            for i, sql in zip(missing, similar):
+                sqls[i] = sql
+            missing = [i for i in missing if sqls[i] is None]
+
+        batch_generated = []
+        if len(missing) > 1:
+            try:
+                batch = await self._generate_many_sql([unique[i] for i in missing])
+                for i, sql in zip(missing, batch):
+                    sqls[i] = sql
+                batch_generated = missing
+            except Exception as e:
+                # fall back to generating each query on its own
+                print(f"[AsyncSQLQueryGeneratorAgent] Batched SQL generation failed, generating one at a time: {e}")
+
+        # JSON queries with small results run together in one DB round-trip. The batch is a task
+        # of its own next to the other queries, only the queries in it wait for it.
+        batch = self._small_query_batch(unique, sqls, output_format)
+        batched = asyncio.ensure_future(self._run_small_queries_batched(batch, output_format)) if batch else None
+        batch_descs = {desc for desc, _ in batch}
+
+        coros = [
+            self._batched_or_one_query(desc, sql, output_format, batched) if desc in batch_descs
+            else self._handle_one_query_or_error(desc, sql, output_format)
+            for desc, sql in zip(unique, sqls)
+        ]
 
-        # format results
-        final_results = []
-        for desc, res in zip(query_descriptions, results):
-            if isinstance(res, Exception):
-                # some error
-                final_results.append({
-                    "query_description": desc,
-                    "generated_sql": None,
-                    "data": None,
-                    "error": str(res)
-                })
+        # run them in parallel. Query failures come back as error dicts, only errors that doom
+        # the whole batch (e.g. a bad API key) raise, and the group then cancels the rest.
+        try:
+            if sys.version_info >= (3, 11):
+                async with asyncio.TaskGroup() as tg:
+                    tasks = [tg.create_task(coro) for coro in coros]
+                results = [task.result() for task in tasks]
             else:
-                res['error'] = None
-                final_results.append(res)
+                results = await asyncio.gather(*coros)
+        finally:
+            if batched is not None:
+                batched.cancel()
+
+        # batch-generated SQL that ran fine is remembered for similar descriptions later
+        if self.semantic_cache is not None:
+            await asyncio.gather(*(
+                self._remember_similar(unique[i], results[i]["generated_sql"])
+                for i in batch_generated
+                if results[i]["error"] is None and results[i]["generated_sql"] == sqls[i]
+            ))
+
+        # results are already in their final shape and order unless there were duplicates
+        if len(unique) == len(query_descriptions):
+            return results
+        by_description = dict(zip(unique, results))
+
+        # fan back out to the caller's order, duplicates get their own copy of the dict
+        final_results = []
+        seen = set()
+        for desc in query_descriptions:
+            res = by_description[desc]
+            final_results.append(dict(res) if desc in seen else res)
+            seen.add(desc)
 
         return final_results
 
-    async def _handle_one_query(self, description: str) -> Dict[str, Any]:
+    async def iter_query_results(self, query_descriptions: List[str]) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Like generate_and_run_queries, but yields each result as soon as its query finishes
+        instead of waiting for the slowest one. Results come in completion order, each
+        carrying its query_description (repeated descriptions are yielded once per repeat).
+        SQL is generated per description here, since a batched LLM call would make
+        every query wait for the whole batch.
+        """
+        counts: Dict[str, int] = {}
+        for desc in query_descriptions:
+            counts[desc] = counts.get(desc, 0) + 1
+
+        tasks = [asyncio.ensure_future(self._handle_one_query_or_error(desc)) for desc in counts]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                res = await next_done
+                for i in range(counts[res["query_description"]]):
+                    yield res if i == 0 else dict(res)
+        finally:
+            # the caller may stop iterating early, don't leave queries running
+            for task in tasks:
+                task.cancel()
+
+    async def _handle_one_query_or_error(
+        self,
+        description: str,
+        sql: Optional[str] = None,
+        output_format: Optional[str] = None
+    ) -> Dict[str, Any]:
         """
-        1) generate SQL from user description,
-        2) run that SQL asynchronously,
-        3) return {desc, generated_sql, data}
+        _handle_one_query, with failures turned into an error result.
+        Errors that would fail every other query too are raised instead.
         """
+        try:
+            return await self._handle_one_query(description, sql, output_format)
+        except FATAL_OPENAI_ERRORS:
+            raise
+        except Exception as e:
+            return {
+                "query_description": description,
+                "generated_sql": None,
+                "data": None,
+                "error": str(e)
+            }
 
-        #start_time = time.perf_counter()
+    def _known_sql(self, description: str) -> Optional[str]:
+        """
+        SQL for the description that doesn't need the LLM: recently generated, or from a template.
+        """
+        sql = self._sql_cache.get(self._sql_cache_key(description))
+        if sql is None and self.template_router is not None:
+            sql = self.template_router.match(description)
+        return sql
 
-        sql = await generate_sql_async(
-            client=self.client,
-            description=description,
-            system_prompt=self.system_prompt,
-            model_name=self.openai_model,
-            temperature=self.temperature
+    async def _similar_sql(self, description: str) -> Optional[str]:
+        """
+        SQL of an earlier, similar enough description from the semantic cache, or None.
+        The cache is blocking (embeddings call + numpy), so it runs in a worker thread,
+        and a failed lookup just means generating the SQL.
+        """
+        try:
+            return await asyncio.to_thread(self.semantic_cache.lookup, description)
+        except Exception as e:
+            print(f"[AsyncSQLQueryGeneratorAgent] Semantic cache lookup failed: {e}")
+            return None
+
+    async def _remember_similar(self, description: str, sql: str) -> None:
+        try:
+            await asyncio.to_thread(self.semantic_cache.add, description, sql)
+        except Exception as e:
+            print(f"[AsyncSQLQueryGeneratorAgent] Semantic cache add failed: {e}")
+
+    def _sql_cache_key(self, description: str) -> Tuple[str, str, float]:
+        digest = hashlib.sha1(normalize_description(description).encode("utf-8")).hexdigest()
+        return (digest, self.openai_model, round(self.temperature, 2))
+
+    def _result_cache_key(self, description: str, output_format: Optional[str] = None) -> Tuple[str, float, str, str]:
+        return (
+            self.openai_model,
+            round(self.temperature, 2),
+            normalize_description(description),
+            output_format or self.output_format
         )
 
-        #end_time = time.perf_counter()
-        #print(f"Generate SQL took {end_time - start_time:.4f} seconds")
+    def _small_query_batch(
+        self,
+        query_descriptions: List[str],
+        sqls: List[Optional[str]],
+        output_format: str
+    ) -> List[Tuple[str, str]]:
+        """
+        The (description, SQL) pairs worth running together in one json_agg round-trip:
+        already generated, valid, small result, and not cached yet. Only JSON is batched,
+        CSV comes from COPY, one statement per query, so there is nothing to batch.
+        """
+        if output_format != "json":
+            return []
+
+        batch = []
+        for desc, sql in zip(query_descriptions, sqls):
+            if sql is None or self._result_cache_key(desc, output_format) in self._result_cache.cache:
+                continue
+            try:
+                validate_select_sql(sql)
+            except SQLValidationError:
+                continue
+            if is_small_result_sql(sql):
+                batch.append((desc, sql))
+
+        return batch if len(batch) >= 2 else []
+
+    async def _run_small_queries_batched(
+        self,
+        batch: List[Tuple[str, str]],
+        output_format: str
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Run the batch in a single round-trip and cache the results.
+        :return: description -> result, empty if the batch failed (its queries then run one at a time)
+        """
+        try:
+            async with self._db_sem:
+                queries = [sql for _, sql in batch]
+                if self.db_pool is not None:
+                    datas = await execute_sql_queries_batched_asyncpg(self.db_pool, queries)
+                else:
+                    datas = await execute_sql_queries_batched_async(self._autocommit_engine, queries)
+        except Exception as e:
+            print(f"[AsyncSQLQueryGeneratorAgent] Batched query execution failed, running one at a time: {e}")
+            return {}
+
+        results = {}
+        for (desc, sql), data in zip(batch, datas):
+            self._sql_cache[self._sql_cache_key(desc)] = sql
+            results[desc] = self._result_cache.cache[self._result_cache_key(desc, output_format)] = {
+                "query_description": desc,
+                "generated_sql": sql,
+                "data": data,
+                "error": None
+            }
+        return results
+
+    async def _batched_or_one_query(
+        self,
+        description: str,
+        sql: str,
+        output_format: str,
+        batched: asyncio.Future
+    ) -> Dict[str, Any]:
+        """
+        The result of a query from the batch, or the query run on its own if the batch failed.
+        """
+        # shielded, several queries wait on the same batch and one being cancelled mustn't cancel it
+        res = (await asyncio.shield(batched)).get(description)
+        if res is not None:
+            return res
+        return await self._handle_one_query_or_error(description, sql, output_format)
+
+    async def _generate_many_sql(self, query_descriptions: List[str]) -> List[str]:
+        """
+        Generate SQL for several descriptions with a single Chat Completions call.
+        """
+        async with self._llm_sem:
+            return await generate_sql_batch_async(
+                client=self.client,
+                descriptions=query_descriptions,
+                system_prompt=self.system_prompt,
+                model_name=self.openai_model,
+                temperature=self.temperature,
+                on_usage=self._record_usage
+            )
+
+    async def _handle_one_query(
+        self,
+        description: str,
+        sql: Optional[str] = None,
+        output_format: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Same as _run_one_query, but repeats of a description within result_cache_ttl
+        reuse the earlier result instead of calling the LLM and the DB again.
+        """
+        output_format = output_format or self.output_format
+        res = await self._result_cache.get_or_set(
+            self._result_cache_key(description, output_format),
+            lambda: self._run_one_query(description, sql, output_format)
+        )
+        # callers fill in/overwrite keys, so don't hand out the cached dict itself
+        return dict(res, query_description=description)
+
+    async def _run_one_query(
+        self,
+        description: str,
+        sql: Optional[str] = None,
+        output_format: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        1) generate SQL from user description (unless it was already generated in a batch),
+           drafting with cheap_model first when one is set,
+        2) run that SQL asynchronously, asking openai_model to fix it if the draft fails
+           or the SQL doesn't pass validation,
+        3) return {desc, generated_sql, data, error} (error is set if the SQL still failed validation)
+        """
 
         #start_time = time.perf_counter()
-        data = await execute_sql_query_async(self.engine, sql, output_format=self.output_format)
+
+        cache_key = self._sql_cache_key(description)
+        if sql is None:
+            sql = self._known_sql(description)
+        if sql is None and self.semantic_cache is not None:
+            sql = await self._similar_sql(description)
+
+        generated = sql is None
+        drafted = generated and self.cheap_model is not None
+        if generated and not drafted:
+            sql = await self._generate_sql(description, self.openai_model)
 
         #end_time = time.perf_counter()
-        #print(f"Execute SQL took {end_time - start_time:.4f} seconds")
+        #print(f"Generate SQL took {end_time - start_time:.4f} seconds")
+
+        try:
+            if drafted:
+                sql = await self._generate_sql(description, self.cheap_model)
+            data = await self._validate_and_execute(sql, output_format)
+        except Exception as e:
+            # A cheap draft gets fixed by openai_model whatever went wrong. Otherwise only SQL
+            # rejected by validation gets a repair call, a DB error (e.g. a timeout) isn't the SQL's fault.
+            if not drafted and not isinstance(e, SQLValidationError):
+                raise
+
+            print(f"[AsyncSQLQueryGeneratorAgent] SQL failed, asking {self.openai_model} to fix it: {e}")
+            if sql is None:
+                repair_description = description
+            else:
+                repair_description = (
+                    f"{description}\n"
+                    f"A previous attempt generated:\n{sql}\n"
+                    f"which failed with: {e}\nFix it."
+                )
+            sql = await self._generate_sql(repair_description, self.openai_model)
+            try:
+                data = await self._validate_and_execute(sql, output_format)
+            except SQLValidationError as e:
+                return {
+                    "query_description": description,
+                    "generated_sql": sql,
+                    "data": None,
+                    "error": str(e)
+                }
+
+        # the SQL ran fine, so it's worth reusing for the same description
+        self._sql_cache[cache_key] = sql
+        if generated and self.semantic_cache is not None:
+            await self._remember_similar(description, sql)
 
         return {
             "query_description": description,
             "generated_sql": sql,
-            "data": data
+            "data": data,
+            "error": None
         }
+
+    async def _generate_sql(self, description: str, model_name: str) -> str:
+        async with self._llm_sem:
+            return await generate_sql_async(
+                client=self.client,
+                description=description,
+                system_prompt=self.system_prompt,
+                model_name=model_name,
+                temperature=self.temperature,
+                on_usage=self._record_usage
+            )
+
+    async def _validate_and_execute(self, sql: str, output_format: Optional[str] = None) -> Union[str, bytes]:
+        """
+        Reject anything that isn't a single read-only SELECT before touching the DB, then run it.
+        Raises SQLValidationError, or whatever the DB driver raises.
+        """
+        validate_select_sql(sql)
+        output_format = output_format or self.output_format
+
+        # the SQL as sqlglot regenerates it from the (cached) tree: formatting differences go away,
+        # string literals stay exactly as written
+        key = (parse_sql(sql)[0].sql(dialect="postgres"), output_format)
+        return await self._sql_result_cache.get_or_set(key, lambda: self._execute(sql, output_format))
+
+    async def _execute(self, sql: str, output_format: str) -> Union[str, bytes]:
+        async with self._db_sem:
+            if self.db_pool is not None:
+                return await execute_sql_query_asyncpg(self.db_pool, sql, output_format=output_format)
+            engine = self.engine if output_format == "json" else self._autocommit_engine
+            return await execute_sql_query_async(engine, sql, output_format=output_format)
@@ -19,11 +19,19 @@ Note:
 """
 
 import os
+import json
+import asyncio
+import threading
+from collections import OrderedDict
 import openai
-from typing import List, Dict, Any
+import sqlalchemy
+from cachetools import TTLCache
+from typing import List, Dict, Any, Optional
 
 # Adjust this import to your actual module/file structure
-from utils.db_query import execute_sql_query
+from utils.db_query import execute_sql_query, execute_sql_query_copy
+from Agents.SemanticCache import SemanticCache
+from Agents.AsyncSQLQueryGeneratorAgent import model_caps, parse_sql, starts_like_sql, strip_code_fences, validate_select_sql
 
 # Example: Provide a global system prompt describing your schema
 SYSTEM_PROMPT = """
@@ -393,110 +401,279 @@ No other text or formatting is needed.
 """ 
 
 
+# Stripped and wrapped once at import instead of on every call
+_SYS = SYSTEM_PROMPT.strip()
+# "developer" is the instruction role every current model accepts (it is "system" for older ones)
+_DEV_MSG = {"role": "developer", "content": _SYS}
+
+# Routes every request to the same prompt cache, the system prompt is the shared prefix
+_PROMPT_CACHE_BODY = {"prompt_cache_key": "sqlgen-v1"}
+
+
 class SQLQueryGeneratorAgent:
     """
     SQLQueryGeneratorAgent uses the OpenAI Chat Completions API (gpt-3.5/4, etc.)
     to convert natural-language queries into valid SQL statements, then executes them.
     """
 
-    def __init__(self, client, db_conn, model_name: str = "gpt-4o", temperature: float = 0.0):
+    def __init__(self, client, db_conn, model_name: str = "gpt-4o", temperature: float = 0.0, max_concurrency: int = 8, semantic_cache: Optional[SemanticCache] = None, sql_cache_size: int = 1024, result_cache_size: int = 256, result_cache_ttl: float = 300):
         """
         :param client: OpenAI Client Object
-        :param db_conn: connection object to database
+        :param db_conn: connection object to database, or a pooled SQLAlchemy Engine (utils.db_connection.get_engine)
+                        so concurrent queries each get their own connection
         :param model_name: e.g., "gpt-3.5-turbo" or "gpt-4"
         :param temperature: controls randomness of the output
+        :param max_concurrency: max descriptions handled at once by generate_and_run_queries_async
+        :param semantic_cache: optional SemanticCache, reuses the SQL of earlier similar descriptions
+        :param sql_cache_size: how many (model, description) -> SQL results to keep for exact repeats
+        :param result_cache_size: how many SQL -> query result entries to keep
+        :param result_cache_ttl: seconds a query result can be reused
         """
         self.client = client
         self.model_name = model_name
         self.temperature = temperature
         self.db_conn = db_conn
+        self.max_concurrency = max_concurrency
+        self.semantic_cache = semantic_cache
+        # (model_name, description) -> SQL, least recently used first
+        self.sql_cache_size = sql_cache_size
+        self._exact_cache: "OrderedDict[tuple, str]" = OrderedDict()
+        self._exact_cache_lock = threading.Lock()
+        # (canonical SQL, output_format) -> result string, so paraphrases that produce the
+        # same SQL don't hit the DB again within a few minutes
+        self._result_cache = TTLCache(maxsize=result_cache_size, ttl=result_cache_ttl)
+        self._result_cache_lock = threading.Lock()
+        # a single SQLAlchemy connection isn't thread-safe, so queries on it take turns.
+        # An Engine hands each query its own pooled connection instead.
+        self._db_lock = threading.Lock()
+        self._db_is_pool = isinstance(db_conn, sqlalchemy.Engine)
 
     def generate_and_run_queries(self, query_descriptions: List[str]) -> List[Dict[str, Any]]:
         """
         For each item in `query_descriptions`, call the Chat Completions API to generate SQL.
         Then run each SQL query using the local `execute_sql_query` function.
+        The descriptions are handled concurrently, see generate_and_run_queries_async.
+        Must not be called from a running event loop (await the async version there instead).
         
         :param query_descriptions: a list of user question strings.
         :return: a list of dictionaries with query results, one per item in `query_descriptions`.
         """
-        results = []
+        return asyncio.run(self.generate_and_run_queries_async(query_descriptions))
 
+    async def generate_and_run_queries_async(self, query_descriptions: List[str]) -> List[Dict[str, Any]]:
+        """
+        Same as generate_and_run_queries, but handles the descriptions concurrently,
+        so N descriptions take about as long as the slowest one instead of the sum.
+        The blocking OpenAI and DB calls run in worker threads, at most max_concurrency at once.
+        Repeated descriptions are only generated and run once.
+        """
+        sem = asyncio.Semaphore(self.max_concurrency)
+
+        # dict keeps the first-seen order, so results can be fanned back out by description
+        unique = list(dict.fromkeys(query_descriptions))
+
+        async def cached(desc: str) -> Optional[str]:
+            async with sem:
+                return await asyncio.to_thread(self._cached_sql, desc)
+
+        # SQL we already have for the same (or a similar) description
+        sqls = await asyncio.gather(*(cached(desc) for desc in unique))
+
+        # the rest is generated with one batched call when there are several
+        missing = [i for i, sql in enumerate(sqls) if sql is None]
+        generated = set()
+        if len(missing) > 1:
+            try:
+                batch = await asyncio.to_thread(self._generate_sql_batch, [unique[i] for i in missing])
+                for i, sql in zip(missing, batch):
+                    sqls[i] = sql
+                    generated.add(i)
+            except Exception as e:
+                # fall back to generating each query on its own
+                print(f"[SQLQueryGeneratorAgent] Batched SQL generation failed, generating one at a time: {e}")
+
+        async def one(i: int) -> Dict[str, Any]:
+            async with sem:
+                return await asyncio.to_thread(self._one, unique[i], sqls[i], i in generated)
+
+        results = await asyncio.gather(*(one(i) for i in range(len(unique))))
+        if len(unique) == len(query_descriptions):
+            return results
+        by_description = dict(zip(unique, results))
+
+        # fan back out to the caller's order, duplicates get their own copy of the dict
+        final_results = []
+        seen = set()
         for desc in query_descriptions:
-            sql = self._generate_sql(desc)
-            # You could do more validation here, e.g. ensure only SELECT is present
-            data = self._run_sql(sql)
-            results.append({
-                "query_description": desc,
-                "generated_sql": sql,
-                "data": data
-            })
+            res = by_description[desc]
+            final_results.append(dict(res) if desc in seen else res)
+            seen.add(desc)
+        return final_results
 
-        return results
+    def clear_cache(self) -> None:
+        """
+        Forget all SQL remembered for exact repeats of a description.
+        """
+        with self._exact_cache_lock:
+            self._exact_cache.clear()
 
-    def _generate_sql(self, description: str) -> str:
+    def _cached_sql(self, desc: str) -> Optional[str]:
         """
-        Calls the Chat Completions API with a system prompt describing the schema
-        and a user message describing the query.
-        Returns the SQL statement string (we expect a single SELECT).
+        SQL from exact repeats first (they don't even need an embedding), then from similar descriptions.
         """
+        with self._exact_cache_lock:
+            sql = self._exact_cache.get((self.model_name, desc))
+            if sql is not None:
+                self._exact_cache.move_to_end((self.model_name, desc))
+                return sql
 
-        if self.model_name == "o1-mini":
+        if self.semantic_cache is not None:
+            return self.semantic_cache.lookup(desc)
+        return None
 
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": f" {SYSTEM_PROMPT.strip()}   Generate a read-only SQL query for: '{description}'"
-                        },
-                    ],
-                }
-            ]
+    def _one(self, desc: str, sql: Optional[str] = None, generated: bool = False) -> Dict[str, Any]:
+        """
+        Generate the SQL (unless it was cached or batch-generated) and run it.
+        :param generated: True if `sql` was freshly generated rather than taken from a cache
+        """
+        if sql is None:
+            sql = self._generate_sql(desc)
+            generated = True
 
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=messages
-            )
-        
-        else:
+        data = self._run_sql(sql)
+
+        # only SQL that actually ran is worth reusing
+        with self._exact_cache_lock:
+            self._exact_cache[(self.model_name, desc)] = sql
+            if len(self._exact_cache) > self.sql_cache_size:
+                self._exact_cache.popitem(last=False)
+        if self.semantic_cache is not None and generated:
+            self.semantic_cache.add(desc, sql)
+
+        return {
+            "query_description": desc,
+            "generated_sql": sql,
+            "data": data
+        }
 
+    def _generate_sql_batch(self, descriptions: List[str]) -> List[str]:
+        """
+        Generates one SQL query per description with a single Chat Completions call,
+        so the system prompt is only sent (and billed) once for the whole batch.
+        Raises ValueError if the model does not return exactly one query per description.
+        """
+        numbered = "\n".join(f"{i}) '{desc}'" for i, desc in enumerate(descriptions, start=1))
+        request = (
+            "Generate a read-only SQL query for each of the following descriptions. "
+            'Return a JSON object of the form {"sql": ["<sql for 1>", "<sql for 2>", ...]} '
+            "with exactly one query per description, in the same order, and nothing else:\n"
+            f"{numbered}"
+        )
+
+        kwargs = self._completion_kwargs(request)
+        if model_caps(self.model_name)["response_format"]:
+            kwargs["response_format"] = {"type": "json_object"}
+        response = self.client.chat.completions.create(**kwargs)
+
+        content = strip_code_fences(response.choices[0].message.content.strip())
+        queries = json.loads(content).get("sql")
+
+        if (
+            not isinstance(queries, list)
+            or len(queries) != len(descriptions)
+            or not all(isinstance(q, str) and q.strip() for q in queries)
+        ):
+            raise ValueError(f"Expected {len(descriptions)} queries from batched generation, got: {content[:200]}")
+
+        return [strip_code_fences(q.strip()) for q in queries]
+
+    def _completion_kwargs(self, request: str) -> Dict[str, Any]:
+        """
+        Chat Completions arguments for one request, the same shape for every model where possible:
+        the schema prompt as a developer message, then the request. Models without an instruction
+        role (o1-mini, o1-preview, see MODEL_CAPS) get the prompt as the first content block instead,
+        so it is still a bit-identical, cacheable prefix.
+        """
+        if model_caps(self.model_name)["system_role"]:
+            messages = [_DEV_MSG, {"role": "user", "content": request}]
+        else:
             messages = [
-                {"role": "system", "content": SYSTEM_PROMPT.strip()},
                 {
                     "role": "user",
-                    "content": f"Generate a read-only SQL query for: '{description}'"
+                    "content": [
+                        {"type": "text", "text": _SYS},
+                        {"type": "text", "text": request},
+                    ],
                 }
             ]
 
+        kwargs = {"model": self.model_name, "messages": messages, "extra_body": _PROMPT_CACHE_BODY}
+        if model_caps(self.model_name)["temperature"]:
+            kwargs["temperature"] = self.temperature
+        return kwargs
 
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=messages,
-                temperature=self.temperature
-            )
-
-        # Typically the response is in response.choices[0].message.content
-        # We assume the model returns only the SQL code in text form
-        sql_code = response.choices[0].message.content.strip()
-   
-
-        # Optional: You might parse out code fences if model includes them
-        # e.g. if sql_code starts with ```sql ...
-        if sql_code.startswith("```"):
-            # strip triple-backticks and possible "sql" label
-            sql_code = sql_code.strip("```").replace("sql\n", "").replace("sql", "")
+    def _generate_sql(self, description: str) -> str:
+        """
+        Calls the Chat Completions API with a system prompt describing the schema
+        and a user message describing the query.
+        Returns the SQL statement string (we expect a single SELECT).
+        """
 
-        return sql_code
+        stream = self.client.chat.completions.create(
+            **self._completion_kwargs(f"Generate a read-only SQL query for: '{description}'"),
+            stream=True
+        )
+
+        # We assume the model returns only the SQL code in text form. The completion is
+        # streamed so we can stop as soon as it starts with something else instead.
+        parts: List[str] = []
+        looks_like_sql = None
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            parts.append(delta)
+
+            if looks_like_sql is None:
+                looks_like_sql = starts_like_sql("".join(parts).lstrip())
+                if looks_like_sql is False:
+                    stream.close()
+                    raise ValueError(f"Model did not return a SQL query: {''.join(parts)[:100]!r}")
+
+        sql_code = "".join(parts).strip()
+
+        # The model sometimes wraps the query in a ```sql fence, remove just the fence
+        return strip_code_fences(sql_code)
 
     def _run_sql(self, sql: str, output_format: str = "json") -> Any:
         """
         Executes the generated SQL using our local db_query() function.
         By default, returns the result as JSON (a string of JSON array),
-        or you can adapt to return CSV, etc.
+        or you can adapt to return CSV, etc. "csv_bytes" returns CSV bytes written by Postgres (COPY).
+        Raises SQLValidationError (before touching the DB) unless the SQL is a single read-only SELECT.
         """
+        # parsed trees are cached by SQL text, so repeated queries aren't parsed again
+        validate_select_sql(sql)
+
+        # the SQL as sqlglot regenerates it from the (cached) tree: formatting differences go away,
+        # string literals stay exactly as written
+        key = (parse_sql(sql)[0].sql(dialect="postgres"), output_format)
+        with self._result_cache_lock:
+            result_str = self._result_cache.get(key)
+        if result_str is not None:
+            return result_str
+
         try:
-            result_str = execute_sql_query(self.db_conn, sql, output_format=output_format)
+            if self._db_is_pool:
+                with self.db_conn.connect() as conn:
+                    result_str = self._execute(conn, sql, output_format)
+            else:
+                with self._db_lock:
+                    result_str = self._execute(self.db_conn, sql, output_format)
+            with self._result_cache_lock:
+                self._result_cache[key] = result_str
             # If output_format == "json", result_str is a JSON string
             # Convert to Python data if you want
             # e.g. for a Python dict/list:
@@ -508,4 +685,8 @@ class SQLQueryGeneratorAgent:
             # Logging, re-raising, or handle the error
             raise RuntimeError(f"SQL execution failed: {e}") from e
 
-
+    @staticmethod
+    def _execute(conn, sql: str, output_format: str) -> Any:
+        if output_format == "csv_bytes":
+            return execute_sql_query_copy(conn, sql)
+        return execute_sql_query(conn, sql, output_format=output_format)
@@ -0,0 +1,190 @@
+import re
+from typing import FrozenSet, Optional
+
+# Single-pass aggregation queries taken from the examples in SQL_SYSTEM_PROMPT,
+# with the player/team and season filled in by TemplateRouter.
+_HITS = "SUM(CASE WHEN event IN ('single','double','triple','home_run') THEN 1 ELSE 0 END)"
+_AB = (
+    "SUM(CASE WHEN event NOT IN ('walk','hit_by_pitch','sac_fly','intent_walk','catcher_interf')\n"
+    "              AND event IS NOT NULL\n"
+    "         THEN 1 ELSE 0 END)"
+)
+_WALKS = "SUM(CASE WHEN event IN ('walk','intent_walk') THEN 1 ELSE 0 END)"
+_HBP = "SUM(CASE WHEN event = 'hit_by_pitch' THEN 1 ELSE 0 END)"
+_SAC_FLY = "SUM(CASE WHEN event = 'sac_fly' THEN 1 ELSE 0 END)"
+_RUNS = "SUM(CASE WHEN post_bat_score > bat_score THEN (post_bat_score - bat_score) ELSE 0 END)"
+_OUTS = (
+    "SUM(CASE\n"
+    "        WHEN event IN ('field_out','strikeout','force_out','other_out',\n"
+    "                       'sac_fly','sac_bunt','fielders_choice_out') THEN 1\n"
+    "        WHEN event IN ('double_play','grounded_into_double_play',\n"
+    "                       'strikeout_double_play','sac_fly_double_play') THEN 2\n"
+    "        WHEN event = 'triple_play' THEN 3\n"
+    "        ELSE 0\n"
+    "    END)"
+)
+
+BATTING_AVERAGE_SQL = f"""SELECT
+    batter_name,
+    {_HITS}::float AS hits,
+    {_AB}::float AS ab,
+    {_HITS}::float / NULLIF({_AB}, 0) AS batting_average
+FROM statcast_pitches
+WHERE game_year = {{year}}
+  AND game_type='R'
+  AND batter_name = '{{player}}'
+GROUP BY batter_name"""
+
+OBP_SQL = f"""SELECT
+    batter_name,
+    {_HITS}::float AS hits,
+    {_AB}::float AS ab,
+    {_WALKS}::float AS walks,
+    {_HBP}::float AS hbp,
+    {_SAC_FLY}::float AS sac_fly,
+    ({_HITS} + {_WALKS} + {_HBP})::float
+      / NULLIF({_AB} + {_WALKS} + {_HBP} + {_SAC_FLY}, 0) AS obp
+FROM statcast_pitches
+WHERE game_year = {{year}}
+  AND game_type='R'
+  AND batter_name = '{{player}}'
+GROUP BY batter_name"""
+
+TEAM_BATTING_AVERAGE_SQL = f"""SELECT
+    CASE WHEN home_team='{{team}}' THEN home_team ELSE away_team END AS team,
+    {_HITS}::float AS hits,
+    {_AB}::float AS ab,
+    {_HITS}::float / NULLIF({_AB}, 0) AS team_batting_average
+FROM statcast_pitches
+WHERE game_year = {{year}}
+  AND game_type='R'
+  AND (home_team='{{team}}' OR away_team='{{team}}')
+GROUP BY CASE WHEN home_team='{{team}}' THEN home_team ELSE away_team END"""
+
+ERA_SQL = f"""SELECT
+    pitcher_name,
+    {_RUNS}::float AS runs_allowed,
+    {_OUTS}::float / 3.0 AS innings_pitched,
+    ({_RUNS}::float * 9.0) / NULLIF({_OUTS}::float / 3.0, 0) AS naive_era
+FROM statcast_pitches
+WHERE game_year = {{year}}
+  AND game_type = 'R'
+  AND pitcher_name = '{{player}}'
+GROUP BY pitcher_name"""
+
+# stat phrase -> template
+_PLAYER_STATS = {
+    "batting average": BATTING_AVERAGE_SQL,
+    "ba": BATTING_AVERAGE_SQL,
+    "avg": BATTING_AVERAGE_SQL,
+    "on base percentage": OBP_SQL,
+    "on-base percentage": OBP_SQL,
+    "obp": OBP_SQL,
+    "era": ERA_SQL,
+    "earned run average": ERA_SQL,
+}
+
+_STAT = "(?P<stat>" + "|".join(sorted((re.escape(s) for s in _PLAYER_STATS), key=len, reverse=True)) + ")"
+# "first last" with an optional suffix, anything longer is left to the LLM
+_PLAYER = r"(?P<player>[a-z][a-z.'-]* [a-z][a-z.'-]*(?: jr\.?| sr\.?| ii| iii)?)"
+_YEAR = r"(?P<year>(?:19|20)\d{2})"
+_QUESTION = r"^(?:what (?:is|was) )?(?:the )?"
+_SEASON = r"(?: (?:regular )?season)?$"
+
+_PLAYER_PATTERNS = [
+    # "batting average for manny machado in 2022"
+    re.compile(_QUESTION + _STAT + r" (?:of|for) " + _PLAYER + r" (?:in|for|during) (?:the )?" + _YEAR + _SEASON),
+    # "manny machado's obp in 2022"
+    re.compile(_QUESTION + _PLAYER + r"'s " + _STAT + r" (?:in|for|during) (?:the )?" + _YEAR + _SEASON),
+]
+_TEAM_PATTERN = re.compile(
+    _QUESTION + r"team (?:batting average|ba|avg) (?:of|for) (?:the )?(?P<team>[a-z]{2,3}) (?:in|for|during) (?:the )?"
+    + _YEAR + _SEASON
+)
+
+# words that mean the description is narrower than the template (a split, a matchup, ...)
+_QUALIFIERS = {"vs", "versus", "against", "with", "without", "at", "on", "off", "from", "home", "away", "when", "and"}
+
+# words that mean the "player" isn't one person's name: articles and determiners, groups
+# of players, handedness, and MLB team nicknames / cities ("the yankees", "all players",
+# "starting pitchers", "new york", "left handed")
+_NOT_A_NAME = {
+    # articles, determiners, pronouns
+    "the", "a", "an", "all", "any", "each", "every", "some", "most", "our", "their", "his", "her",
+    "my", "this", "that", "these", "those", "top", "best", "worst", "league", "team", "teams",
+    # groups, roles, splits
+    "players", "player", "pitchers", "pitcher", "batters", "batter", "hitters", "hitter",
+    "starters", "starter", "starting", "relievers", "reliever", "relief", "catchers", "catcher",
+    "infielders", "outfielders", "rookies", "rookie", "qualified", "left", "right", "handed",
+    "lefties", "righties", "lefty", "righty", "switch", "american", "national", "mlb", "al", "nl",
+    # team nicknames
+    "yankees", "red", "sox", "blue", "jays", "orioles", "rays", "guardians", "indians", "tigers",
+    "twins", "royals", "white", "astros", "angels", "athletics", "a's", "mariners", "rangers",
+    "braves", "marlins", "mets", "phillies", "nationals", "cubs", "reds", "brewers", "pirates",
+    "cardinals", "diamondbacks", "dbacks", "d-backs", "rockies", "dodgers", "padres", "giants",
+    # team cities / regions
+    "new", "york", "boston", "toronto", "baltimore", "tampa", "bay", "cleveland", "detroit",
+    "minnesota", "kansas", "city", "chicago", "houston", "los", "angeles", "anaheim", "oakland",
+    "seattle", "texas", "atlanta", "miami", "florida", "philadelphia", "washington", "milwaukee",
+    "cincinnati", "pittsburgh", "st.", "st", "louis", "arizona", "colorado", "san", "diego",
+    "francisco", "sacramento",
+}
+
+
+class TemplateRouter:
+    """
+    Answers descriptions that plainly ask for one of the canned stats in the system prompt
+    (player BA, OBP, naive ERA, team BA for a season) with its template SQL, so they
+    don't need an LLM call. Anything it isn't sure about returns None and goes to the LLM.
+    """
+
+    def match(self, description: str) -> Optional[str]:
+        """
+        :return: the SQL for the description, or None if no template applies
+        """
+        text = " ".join(description.lower().split()).rstrip("?.! ")
+
+        m = _TEAM_PATTERN.match(text)
+        if m:
+            return TEAM_BATTING_AVERAGE_SQL.format(team=m.group("team").upper(), year=m.group("year"))
+
+        for pattern in _PLAYER_PATTERNS:
+            m = pattern.match(text)
+            if m is None:
+                continue
+            player = m.group("player")
+            words = player.split()
+            if _QUALIFIERS.intersection(words) or _NOT_A_NAME.intersection(words):
+                # not plainly one player, the LLM path can work out what was meant
+                return None
+            template = _PLAYER_STATS[m.group("stat")]
+            return template.format(player=player.replace("'", "''"), year=m.group("year"))
+
+        return None
+
+
+# numbers anywhere (seasons, thresholds, limits), and capitalized words that don't start a sentence
+# (player names, team codes)
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+_NAME_WORD = re.compile(r"(?<![.?!]\s)(?<!^)\b[A-Z][A-Za-z.'-]*")
+
+
+def description_entities(description: str) -> FrozenSet[str]:
+    """
+    The literal values a description pins down: its numbers, the player or team the template
+    patterns find, and capitalized name-like words. Two descriptions that differ in any of them
+    ("Judge HRs 2022" / "Judge HRs 2023") ask for different data, however similar they read.
+    """
+    entities = set(_NUMBER.findall(description))
+    entities.update(word.lower() for word in _NAME_WORD.findall(description.strip()))
+
+    text = " ".join(description.lower().split()).rstrip("?.! ")
+    m = _TEAM_PATTERN.match(text)
+    if m:
+        entities.add(m.group("team"))
+    for pattern in _PLAYER_PATTERNS:
+        m = pattern.match(text)
+        if m:
+            entities.update(m.group("player").split())
+            break
+    return frozenset(entities)
@@ -0,0 +1,153 @@
+import hashlib
+import sqlite3
+import threading
+from functools import lru_cache
+from typing import Dict, FrozenSet, List, Optional
+
+import numpy as np
+
+from Agents.SQLTemplateRouter import description_entities
+
+# Rows scored per matmul during lookups, bounds the temporary float32 copy of the int8 codes
+_SCORE_BLOCK = 4096
+
+# Rows the in-memory code matrix starts with, it doubles whenever it is full
+_INITIAL_CAPACITY = 256
+
+
+class SemanticCache:
+    """
+    A description -> SQL cache that also matches paraphrased descriptions:
+      - Each description is embedded (text-embedding-3-small by default) and normalized,
+        so the dot product of two embeddings is their cosine similarity.
+      - A lookup returns the stored SQL of the most similar description that is at least
+        `threshold` similar and names the same numbers, players and teams (description_entities),
+        since descriptions that only differ in those read alike but need different SQL.
+      - Entries are persisted in SQLite (float32) and searched in memory with numpy. In memory
+        each embedding is kept as int8 codes plus one float scale, 4x smaller than float32,
+        which costs well under 0.01 of cosine similarity.
+    Thread-safe, so it can be shared by the worker threads of SQLQueryGeneratorAgent.
+    """
+
+    def __init__(
+        self,
+        client,
+        db_path: str = "semantic_cache.sqlite3",
+        threshold: float = 0.95,
+        embedding_model: str = "text-embedding-3-small",
+        embed_cache_size: int = 1024
+    ):
+        """
+        :param client: OpenAI Client Object (sync), used for the embeddings
+        :param db_path: SQLite file the entries are persisted in
+        :param threshold: minimum cosine similarity for a hit
+        :param embedding_model: OpenAI embedding model
+        :param embed_cache_size: how many exact description -> embedding results to keep in memory
+        """
+        self.client = client
+        self.threshold = threshold
+        self.embedding_model = embedding_model
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " hash TEXT PRIMARY KEY,"
+            " description TEXT NOT NULL,"
+            " embedding BLOB NOT NULL,"
+            " sql TEXT NOT NULL)"
+        )
+        self._db.commit()
+
+        # load everything once, lookups only touch memory.
+        # Rows [0, _size) of _codes/_scales are in use, the rest is room to grow into.
+        self._index: Dict[str, int] = {}
+        self._sqls: List[str] = []
+        self._entities: List[FrozenSet[str]] = []
+        self._codes: Optional[np.ndarray] = None
+        self._scales: Optional[np.ndarray] = None
+        self._size = 0
+        for key, description, emb, sql in self._db.execute("SELECT hash, description, embedding, sql FROM entries"):
+            self._append(key, description, np.frombuffer(emb, dtype=np.float32), sql)
+
+        # repeats of the exact same description don't need another embeddings call
+        self._embed_cached = lru_cache(maxsize=embed_cache_size)(self._embed)
+
+    def lookup(self, description: str) -> Optional[str]:
+        """
+        :return: the cached SQL for the most similar description, or None if nothing is similar enough
+        """
+        with self._lock:
+            if self._size == 0:
+                return None
+        emb = self._embed_cached(description)
+        entities = description_entities(description)
+
+        with self._lock:
+            # every entry over the threshold, best first, the first one naming the same entities wins
+            hits = []
+            for start in range(0, self._size, _SCORE_BLOCK):
+                stop = min(start + _SCORE_BLOCK, self._size)
+                scores = (self._codes[start:stop].astype(np.float32) @ emb) * self._scales[start:stop]
+                for i in np.flatnonzero(scores >= self.threshold):
+                    hits.append((float(scores[i]), start + int(i)))
+            for _, row in sorted(hits, reverse=True):
+                if self._entities[row] == entities:
+                    return self._sqls[row]
+            return None
+
+    def add(self, description: str, sql: str) -> None:
+        """
+        Store the SQL for a description (replacing any previous SQL for the exact same text).
+        """
+        emb = self._embed_cached(description)
+        key = hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (hash, description, embedding, sql) VALUES (?, ?, ?, ?)",
+                (key, description, emb.tobytes(), sql)
+            )
+            self._db.commit()
+
+            row = self._index.get(key)
+            if row is not None:
+                self._sqls[row] = sql
+                return
+            self._append(key, description, emb, sql)
+
+    def _append(self, key: str, description: str, emb: np.ndarray, sql: str) -> None:
+        """
+        Add one entry to the in-memory index (caller holds the lock, or is __init__).
+        """
+        code, scale = _quantize(emb)
+        if self._codes is None:
+            self._codes = np.empty((_INITIAL_CAPACITY, len(code)), dtype=np.int8)
+            self._scales = np.empty(_INITIAL_CAPACITY, dtype=np.float32)
+        elif self._size == len(self._codes):
+            # double the capacity, so the copies add up to O(1) per insert
+            self._codes = np.concatenate([self._codes, np.empty_like(self._codes)])
+            self._scales = np.concatenate([self._scales, np.empty_like(self._scales)])
+
+        self._codes[self._size] = code
+        self._scales[self._size] = scale
+        self._index[key] = self._size
+        self._sqls.append(sql)
+        self._entities.append(description_entities(description))
+        self._size += 1
+
+    def _embed(self, description: str) -> np.ndarray:
+        response = self.client.embeddings.create(model=self.embedding_model, input=description)
+        emb = np.asarray(response.data[0].embedding, dtype=np.float32)
+        # normalized once here, so similarity is just a dot product
+        return emb / np.linalg.norm(emb)
+
+
+def _quantize(emb: np.ndarray):
+    """
+    Symmetric int8 quantization with one scale per vector: emb ~= code * scale.
+    """
+    peak = float(np.abs(emb).max())
+    scale = peak / 127.0 if peak > 0 else 1.0
+    code = np.clip(np.rint(emb / scale), -127, 127).astype(np.int8)
+    return code, scale
@@ -1,8 +1,16 @@
+import asyncio
+import csv
 import io
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Set, Union
 
 from Agents.AsyncSQLQueryGeneratorAgent import AsyncSQLQueryGeneratorAgent
 
+# Run polling, in seconds
+RUN_POLL_INITIAL_INTERVAL = 0.25
+RUN_POLL_BACKOFF = 1.5
+RUN_POLL_MAX_INTERVAL = 2.0
+RUN_TERMINAL_STATUSES = {"completed", "failed", "cancelled", "expired", "incomplete", "requires_action"}
+
 class VisualizationAgent:
     """
     A class to handle the creation of data visualizations by:
@@ -32,6 +40,15 @@ class VisualizationAgent:
         self.client = openai_client
         self.visualization_assistant_id = visualization_assistant_id
         self.csv_schema_mapping = csv_schema_mapping or {}
+        # background thread deletions that haven't finished yet
+        self._pending_deletes: Set[asyncio.Task] = set()
+
+    async def aclose(self) -> None:
+        """
+        Wait for the background thread deletions, call before closing the OpenAI client.
+        """
+        if self._pending_deletes:
+            await asyncio.gather(*self._pending_deletes, return_exceptions=True)
 
     async def create_visualization(self, visualization_description: str) -> str:
         """
@@ -49,38 +66,47 @@ class VisualizationAgent:
         # Step 1: Gather data from the Async SQL Query Agent as CSV
         query_prompt = f"Gather the data necessary for making this visualization: {visualization_description}"
 
+        # Step 2 is started right away: the thread doesn't depend on the data, so creating it
+        # is hidden behind the SQL generation + execution instead of waiting for it.
         # generate_and_run_queries returns a list of dicts
-        # e.g. [ { "query_description": ..., "generated_sql": ..., "data": <CSV_STRING> }, ... ]
+        # e.g. [ { "query_description": ..., "generated_sql": ..., "data": <CSV_BYTES> }, ... ]
+        # The CSV comes back as bytes straight from the DB, it is only ever uploaded as a file.
         #print("getting data")
-        results = await self.async_sql_query_agent.generate_and_run_queries([query_prompt])
-        #print(results[0]['generated_sql'], results[0]['error'])
-        csv_data = results[0]["data"]
-        if not csv_data:
-            raise RuntimeError("No CSV data returned from SQL agent. Can't proceed with visualization.")
-
-        # Step 1.1: Check CSV size (must be < 512 MB)
-        csv_bytes = csv_data.encode("utf-8")
-        if len(csv_bytes) > 512 * 1024 * 1024:
-            raise RuntimeError("CSV data exceeds 512 MB limit for file attachments.")
-        
-        #print(csv_data[0:100])
+        sql_task = asyncio.create_task(
+            self.async_sql_query_agent.generate_and_run_queries([query_prompt], output_format="csv_bytes")
+        )
+        thread_task = asyncio.create_task(self.client.beta.threads.create())
+
+        try:
+            results = await sql_task
+            #print(results[0]['generated_sql'], results[0]['error'])
+            csv_bytes = results[0]["data"]
+            if not csv_bytes:
+                raise RuntimeError("No CSV data returned from SQL agent. Can't proceed with visualization.")
+
+            # Step 1.1: Check CSV size (must be < 512 MB)
+            if len(csv_bytes) > 512 * 1024 * 1024:
+                raise RuntimeError("CSV data exceeds 512 MB limit for file attachments.")
+        except BaseException:
+            await self._discard_thread(thread_task)
+            raise
+
+        #print(csv_bytes[0:100])
 
         # (Optional) Step 4: parse CSV columns & build a descriptive user message
-        # columns = self._extract_csv_columns(csv_data)
+        # columns = self._extract_csv_columns(csv_bytes)
         # columns_desc = self._build_columns_desc(columns)
         # We might incorporate columns_desc into the user_msg_content if desired.
 
-        # Step 2: Create a new thread with the Visualization Assistant
+        # Step 3: Upload the CSV file while the thread creation (if still pending) finishes.
+        # Whatever happens from here on, the thread and the uploaded file are cleaned up in
+        # the finally (deleted if they were created, cancelled if still pending).
         #print('Creating thread')
-        new_thread = await self.client.beta.threads.create()
-        thread_id = new_thread.id
-        #print(f'Thread id: {thread_id}')
-
+        upload_task = asyncio.create_task(self._upload_csv(csv_bytes))
         try:
-
-            #print("creating csv file")
-            # Step 3: Upload the CSV file to the thread
-            csv_file_id = await self._upload_csv_to_thread(thread_id, csv_bytes)
+            new_thread, csv_file_id = await asyncio.gather(thread_task, upload_task)
+            thread_id = new_thread.id
+            #print(f'Thread id: {thread_id}')
 
             # Step 4: Build user message describing the chart (plus any column info if desired)
             user_msg_content = (
@@ -106,11 +132,11 @@ class VisualizationAgent:
             #print("running thread")
 
             # Step 5: Start a Run with the Visualization Assistant
-            run = await self.client.beta.threads.runs.create_and_poll(
+            run = await self.client.beta.threads.runs.create(
                 thread_id=thread_id,
-                assistant_id=self.visualization_assistant_id,
-                poll_interval_ms=2000  # Poll every 2 seconds
+                assistant_id=self.visualization_assistant_id
             )
+            run = await self._wait_for_run(thread_id, run)
             if run.status != "completed":
                 raise RuntimeError(f"Run did not complete successfully: {run}")
             
@@ -125,23 +151,76 @@ class VisualizationAgent:
             #print("downloading file")
             #local_img_path = await self._download_file(image_file_id, "final_plot.png")
 
-            #delete thread
-            await self.client.beta.threads.delete(thread_id)
-
             return image_file_id
-        
-        except Exception as e:
-            #delete thread
-            await self.client.beta.threads.delete(thread_id)
-            raise(e)
+
+        finally:
+            # delete thread and CSV file (in the background, the caller doesn't need to wait for it)
+            await self._discard_thread(thread_task)
+            await self._discard_file(upload_task)
 
     # ----------------------------------------------------------------
     # Internal helper methods
     # ----------------------------------------------------------------
-    async def _upload_csv_to_thread(self, thread_id: str, csv_bytes: bytes) -> str:
+    async def _wait_for_run(self, thread_id: str, run):
+        """
+        Poll a run until it reaches a terminal status. The interval starts short, since
+        simple charts finish in about a second, and backs off to RUN_POLL_MAX_INTERVAL.
+        """
+        interval = RUN_POLL_INITIAL_INTERVAL
+        while run.status not in RUN_TERMINAL_STATUSES:
+            await asyncio.sleep(interval)
+            interval = min(interval * RUN_POLL_BACKOFF, RUN_POLL_MAX_INTERVAL)
+            run = await self.client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+        return run
+
+    async def _discard_thread(self, thread_task: asyncio.Task) -> None:
+        """
+        Cancel a pending thread creation, or delete the thread if it was already created.
+        """
+        if not thread_task.done():
+            thread_task.cancel()
+        try:
+            new_thread = await thread_task
+        except BaseException:
+            # cancelled or failed, so there is no thread to clean up
+            return
+        self._schedule_delete(new_thread.id)
+
+    async def _discard_file(self, upload_task: asyncio.Task) -> None:
+        """
+        Cancel a pending CSV upload, or delete the file if it was already uploaded.
+        """
+        if not upload_task.done():
+            upload_task.cancel()
+        try:
+            file_id = await upload_task
+        except BaseException:
+            # cancelled or failed, so there is no file to clean up
+            return
+        self._schedule_delete(file_id, kind="file")
+
+    def _schedule_delete(self, object_id: str, kind: str = "thread") -> None:
+        """
+        Delete a thread (or, with kind="file", a file) without blocking the caller. The task is
+        kept in _pending_deletes so it isn't garbage collected mid-flight and can be awaited by aclose().
+        """
+        task = asyncio.create_task(self._safe_delete(object_id, kind))
+        self._pending_deletes.add(task)
+        task.add_done_callback(self._pending_deletes.discard)
+
+    async def _safe_delete(self, object_id: str, kind: str = "thread") -> None:
+        try:
+            if kind == "file":
+                await self.client.files.delete(object_id)
+            else:
+                await self.client.beta.threads.delete(object_id)
+        except Exception as e:
+            print(f"[VisualizationAgent] Failed to delete {kind} {object_id}: {e}")
+
+    async def _upload_csv(self, csv_bytes: bytes) -> str:
         """
         Upload CSV data (as bytes) as a file to the Assistants API
-        and return the newly created file ID.
+        and return the newly created file ID (attached to the thread's message afterwards).
         """
         file_resp = await self.client.files.create(
             file=io.BytesIO(csv_bytes),
@@ -158,25 +237,22 @@ class VisualizationAgent:
 
         #print(f"Steps list: {steps_list}")
 
-        # Check the last messages in the thread
-        messages_page = await self.client.beta.threads.messages.list(thread_id=thread_id)
-        messages_list = messages_page.data  # This is a list of Message objects
-        #print(messages_list)
-
-        image_file_id = None
+        # Only the newest messages can hold the chart, so ask for those (newest first)
+        # instead of the whole thread
+        messages_page = await self.client.beta.threads.messages.list(
+            thread_id=thread_id,
+            order="desc",
+            limit=5
+        )
+        #print(messages_page.data)
 
-        # We iterate from last message to first (the newest is typically at the end)
-        for msg in reversed(messages_list):
+        for msg in messages_page.data:
             # msg.content is a list of ContentBlock (ImageFileContentBlock, TextContentBlock, etc.)
             for block in msg.content:
                 if block.type == "image_file":
-                    image_file_id = block.image_file.file_id
-                    break
-
-            if image_file_id:
-                break
+                    return block.image_file.file_id
 
-        return image_file_id
+        return None
 
     async def _download_file(self, file_id: str, local_name: str) -> str:
         """
@@ -190,12 +266,16 @@ class VisualizationAgent:
         return local_name
 
     # (Optional)
-    def _extract_csv_columns(self, csv_data: str) -> List[str]:
+    def _extract_csv_columns(self, csv_data: Union[str, bytes]) -> List[str]:
         """
         Basic utility to parse the first line of CSV to get column headers.
+        Only the header line is read, and quoted headers (with commas) are handled.
         """
-        lines = csv_data.strip().split("\n")
-        headers = lines[0].split(",")
+        if isinstance(csv_data, bytes):
+            stream = io.TextIOWrapper(io.BytesIO(csv_data), encoding="utf-8", newline="")
+        else:
+            stream = io.StringIO(csv_data, newline="")
+        headers = next(csv.reader(stream), [])
         return [h.strip() for h in headers]
 
     def _build_columns_desc(self, columns: List[str]) -> str:
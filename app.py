@@ -1,17 +1,23 @@
 import os
+import re
 import asyncio
-from quart import Quart, request, jsonify
+from quart import Quart, Response, request, jsonify
 from quart_cors import cors
-from typing import Optional
-import base64
+from typing import Optional, Tuple
+import binascii
+import httpx
 
 from dotenv import load_dotenv
 load_dotenv()
 
 
-from openai import AsyncOpenAI
-from asyncutils.async_db_connection import get_async_engine
+import openai
+from openai import AsyncOpenAI, OpenAI
+from cachetools import TTLCache
+from asyncutils.async_cache import SingleFlightCache
+from asyncutils.async_db_connection import get_async_engine, get_asyncpg_pool
 from Agents.AsyncSQLQueryGeneratorAgent import AsyncSQLQueryGeneratorAgent
+from Agents.SemanticCache import SemanticCache
 from Agents.VisualizationAgent import VisualizationAgent
 from Agents.AnalystAgent import AnalystAgent
 
@@ -21,33 +27,92 @@ app = cors(app, allow_origin="*")
 # Global references
 openai_client: Optional[AsyncOpenAI] = None
 db_engine = None
+db_pool = None
 sql_agent: Optional[AsyncSQLQueryGeneratorAgent] = None
 viz_agent: Optional[VisualizationAgent] = None
 analyst_agent: Optional[AnalystAgent] = None
 
+# file_id -> file bytes. Assistant files never change, so the only limits are memory
+# (FILE_CACHE_BYTES in total, sized by len) and a generous TTL. Files bigger than an
+# eighth of the cache are served but not kept, so one upload can't flush everything else.
+FILE_CACHE_BYTES = int(os.getenv("FILE_CACHE_BYTES", str(64 * 1024 * 1024)))
+FILE_CACHE_TTL = float(os.getenv("FILE_CACHE_TTL", str(6 * 3600)))
+file_cache = SingleFlightCache(
+    TTLCache(maxsize=FILE_CACHE_BYTES, ttl=FILE_CACHE_TTL, getsizeof=len),
+    should_cache=lambda data: len(data) <= FILE_CACHE_BYTES // 8
+)
+# Downloads are read in pieces of this size (see _stream_file)
+FILE_STREAM_CHUNK = 64 * 1024
+# file_id -> base64 of the file, for inline_images responses (same limits, so the encode is skipped too)
+file_b64_cache = SingleFlightCache(
+    TTLCache(maxsize=FILE_CACHE_BYTES, ttl=FILE_CACHE_TTL, getsizeof=len),
+    should_cache=lambda data: len(data) <= FILE_CACHE_BYTES // 8
+)
+
 @app.before_serving
 async def startup():
     """
     Called once when the server starts (before handling requests).
     Great place to do async initialization for DB engine, agent objects, etc.
     """
-    global openai_client, db_engine, sql_agent, viz_agent, analyst_agent
+    global openai_client, db_engine, db_pool, sql_agent, viz_agent, analyst_agent
 
     # 1) Setup openai_client
+    # This single client (and its HTTP/2 keep-alive pool) is shared by every agent and
+    # lives for the whole process, so requests reuse connections instead of new TLS handshakes.
+    # The read timeout leaves room for reasoning models that think before streaming.
     openai_api_key = os.getenv("OPENAI_API_KEY", "")
-    openai_client = AsyncOpenAI(api_key=openai_api_key)
+    openai_http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(120.0, connect=5.0),
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+    )
+    # The SDK retries 408/409/429/5xx and timeouts with jittered exponential backoff and
+    # honors Retry-After, so transient failures don't surface as dead query results.
+    openai_max_retries = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+    openai_client = AsyncOpenAI(
+        api_key=openai_api_key,
+        http_client=openai_http_client,
+        max_retries=openai_max_retries
+    )
     print("[startup] OpenAI client created")
 
     # 2) Setup db engine
-    db_engine = await get_async_engine("statcast")
+    db_pool_size = int(os.getenv("DB_POOL_SIZE", "10"))
+    db_engine = await get_async_engine("statcast", pool_size=db_pool_size)
     print("[startup] DB engine created for statcast")
 
+    # DB_DRIVER=asyncpg runs the generated queries on a raw asyncpg pool instead of the engine
+    if os.getenv("DB_DRIVER", "sqlalchemy").lower() == "asyncpg":
+        db_pool = await get_asyncpg_pool("statcast", max_size=db_pool_size)
+        print("[startup] asyncpg pool created for statcast")
+
     # 3) Create the SQL Query Agent
+    # Bound the fan-out so a burst of descriptions can't trigger 429s from OpenAI
+    # or queue up behind the pool. DB concurrency never goes above the pool size.
+    llm_concurrency = int(os.getenv("LLM_CONC", "8"))
+    db_concurrency = min(int(os.getenv("DB_CONC", str(db_pool_size))), db_pool_size)
+    # SEMANTIC_CACHE_PATH turns on reuse of SQL across paraphrased questions (persisted in SQLite).
+    # The cache is blocking and runs in worker threads, so it gets its own sync client for embeddings.
+    semantic_cache = None
+    semantic_cache_path = os.getenv("SEMANTIC_CACHE_PATH")
+    if semantic_cache_path:
+        semantic_cache = SemanticCache(
+            client=OpenAI(api_key=openai_api_key, max_retries=openai_max_retries),
+            db_path=semantic_cache_path,
+            threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+        )
+        print(f"[startup] Semantic cache loaded from {semantic_cache_path}")
     sql_agent = AsyncSQLQueryGeneratorAgent(
         client=openai_client,
         engine=db_engine,
         openai_model="o1-mini",
-        output_format='csv'
+        output_format='csv',
+        db_concurrency=db_concurrency,
+        llm_concurrency=llm_concurrency,
+        db_pool=db_pool,
+        cheap_model=os.getenv("SQL_CHEAP_MODEL") or None,
+        semantic_cache=semantic_cache
     )
     print("[startup] SQL Query Agent created")
 
@@ -73,6 +138,22 @@ async def startup():
 
     print("[startup] All agents and engine are initialized.")
 
+@app.after_serving
+async def shutdown():
+    """
+    Called once when the server stops. Closes the shared OpenAI HTTP connection pool
+    and the asyncpg pool if there is one.
+    """
+    if viz_agent is not None:
+        # its background thread deletions still need the OpenAI client
+        await viz_agent.aclose()
+    if openai_client is not None:
+        await openai_client.close()
+        print("[shutdown] OpenAI client closed")
+    if db_pool is not None:
+        await db_pool.close()
+        print("[shutdown] asyncpg pool closed")
+
 @app.route('/health', methods=['GET'])
 def health():
     return jsonify({'status': 'healthy'}), 200
@@ -91,11 +172,12 @@ async def create_thread():
 @app.route("/add_message", methods=["POST"])
 async def add_message():
     """
-    1) Read JSON: { "thread_id": str, "user_message": str }
+    1) Read JSON: { "thread_id": str, "user_message": str, "inline_images": bool (optional) }
     2) Add user message to that thread
     3) Let analyst_agent handle the query
     4) Parse final assistant response from the thread
-    5) Return final answer (with any images) as JSON
+    5) Return final answer as JSON. Images are referenced by "image_url" (served by /images/<file_id>),
+       and only inlined as base64 in "image" when inline_images is true.
     """
     global openai_client, analyst_agent
 
@@ -105,6 +187,7 @@ async def add_message():
 
     thread_id = data["thread_id"]
     user_message = data["user_message"]
+    inline_images = bool(data.get("inline_images", False))
 
     # Step 1: Add user message
     user_msg = await openai_client.beta.threads.messages.create(
@@ -118,85 +201,232 @@ async def add_message():
     await analyst_agent.handle_query(thread_id)
 
     # Step 3: Retrieve final assistant messages
-    msgs_page = await openai_client.beta.threads.messages.list(thread_id=thread_id)
-    msgs_list = msgs_page.data
+    # Only the messages after this turn's user message are needed, not the whole history.
+    # The async iteration follows the pages if the turn has more than one page of messages.
+    msgs_list = []
+    async for msg in openai_client.beta.threads.messages.list(
+        thread_id=thread_id,
+        order="asc",
+        after=user_msg.id,
+        limit=100
+    ):
+        msgs_list.append(msg)
+    # newest first, as the loop below expects
+    msgs_list.reverse()
 
     # We'll iterate from last to first (the newest message to oldest).
     # We'll keep track of everything until we see a user message
     # whose text doesn't begin with "[Tool]".
-    print(msgs_list)
-    collected_messages = []
+    # This first pass only picks the messages (no awaits), they are parsed concurrently below.
+    # (Don't print the message objects, on long turns the repr is huge and print blocks the event loop)
+    candidates = []  # (msg, is_tool_msg)
     for msg in msgs_list:
-        if msg.role == "assistant":
+        # each attribute is read once per message
+        role = msg.role
+        if role == "assistant":
             # This is presumably the final answer from the agent.
             # We want to keep this message in the final output.
             # Parse out text blocks, image blocks if any.
-            parsed = await parse_message(msg)
-            collected_messages.append(parsed)
+            candidates.append((msg, False))
 
-        elif msg.role == "user":
+        elif role == "user":
             # Check the text blocks. If the first text block (or any block)
             # starts with "[Tool]", then it's a tool output message, 
             # so we also want to keep it (since it might have images).
             # If it doesn't start with "[Tool]", that means we
             # have found the original user query => break.
-            is_tool_msg = False
-            if msg.content:
-                first_block = msg.content[0]
-                if first_block.type == "text":
-                    if first_block.text.value.startswith("[Tool]"):
-                        # This is a tool message. We keep it and possibly parse images.
-                        parsed = await parse_message(msg)
-                        if parsed['image']:
-                            collected_messages.append(parsed)
-                        is_tool_msg = True
-            
-            if not is_tool_msg:
+            content = msg.content
+            first_block = content[0] if content else None
+            if (
+                first_block is not None
+                and first_block.type == "text"
+                and first_block.text.value.startswith("[Tool]")
+            ):
+                # This is a tool message. We keep it if it has an image.
+                candidates.append((msg, True))
+            else:
                 # This is the real user's query => stop collecting further.
                 break
 
-
+    # Each parse may download an image, so run them at once (gather keeps the order)
+    parsed_list = await asyncio.gather(*(parse_message(msg, inline_images) for msg, _ in candidates))
+    collected_messages = [
+        parsed for parsed, (_, is_tool_msg) in zip(parsed_list, candidates)
+        if not is_tool_msg or parsed['image_url']
+    ]
 
     collected_messages.reverse()
 
-    print(collected_messages)
+    print(f"[add_message] Returning {len(collected_messages)} message(s) for thread={thread_id}")
 
     # Return them as JSON
     return jsonify({"messages": collected_messages})
 
-async def parse_message(msg):
+async def parse_message(msg, inline_images: bool = False):
     """
     Returns something like:
     {
       "role": "assistant" or "user",
       "text": "some text combined",
-      "images": [ { "file_id": ..., "base64": ... } ... ]
+      "image_url": "/images/<file_id>" or None,
+      "image": base64 of the image, only if inline_images (otherwise None)
     }
     """
     text_buf = ''
     image = None
+    image_url = None
 
+    image_file_id = None
     if msg.content:
         for block in msg.content:
             if block.type == "text":
                 text_buf = block.text.value
             elif block.type == "image_file":
-                # we have an image file
-                file_id = block.image_file.file_id
-                # Download the image if you want base64
-                file_resp = await openai_client.files.content(file_id)
-                image_bytes = file_resp.read()
+                # we have an image file, only the last one ends up in the response
+                image_file_id = block.image_file.file_id
+
+    if image_file_id is not None:
+        image_url = f"/images/{image_file_id}"
 
-                image = base64.b64encode(image_bytes).decode("utf-8")
+        if inline_images:
+            # Download the image if you want base64
+            image = await fetch_file_b64(image_file_id)
 
 
     return {
         "role": msg.role,
         "text": text_buf,
+        "image_url": image_url,
         "image": image
     }
 
-# For local runs
+# OpenAI file ids, anything else is rejected before calling the API
+_FILE_ID = re.compile(r"^file-[A-Za-z0-9_-]+$")
+
+# /images only serves chart images: the re-uploads AnalystAgent makes for the thread ("vision")
+# or code interpreter output, with an image file name. Other files in the account (CSV uploads,
+# assistant files, ...) are reported as not found.
+_IMAGE_FILE_PURPOSES = {"vision", "assistants_output"}
+_IMAGE_FILE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp")
+# file_id -> whether it is a chart image, file metadata never changes either
+image_check_cache = SingleFlightCache(TTLCache(maxsize=4096, ttl=FILE_CACHE_TTL))
+
+@app.route("/images/<file_id>", methods=["GET"])
+async def get_image(file_id: str):
+    """
+    Serves an image produced by the assistants as raw bytes, so /add_message
+    only has to return its URL instead of inlining it as base64.
+    """
+    if not _FILE_ID.match(file_id):
+        return jsonify({"error": "Invalid file_id"}), 400
+
+    try:
+        if not await is_chart_image(file_id):
+            return jsonify({"error": "Image not found"}), 404
+        image_bytes = await fetch_file_bytes(file_id)
+    except openai.NotFoundError:
+        return jsonify({"error": "Image not found"}), 404
+    except openai.RateLimitError:
+        return jsonify({"error": "Image service is busy, try again later"}), 429, {"Retry-After": "5"}
+    except openai.APIError as e:
+        # permission, connection and server errors on the OpenAI side, not the client's fault
+        print(f"[get_image] Failed to fetch file {file_id}: {e}")
+        return jsonify({"error": "Could not fetch image"}), 502
+
+    mimetype = _image_mimetype(image_bytes)
+    if not mimetype.startswith("image/"):
+        return jsonify({"error": "Image not found"}), 404
+
+    # file ids are never reused, so clients can cache the image for good
+    return Response(
+        image_bytes,
+        mimetype=mimetype,
+        headers={"Cache-Control": "public, max-age=31536000, immutable"}
+    )
+
+async def is_chart_image(file_id: str) -> bool:
+    """
+    Whether the file's metadata says it is a chart image (see _IMAGE_FILE_PURPOSES), checked once per file.
+    """
+    async def check() -> bool:
+        file_obj = await openai_client.files.retrieve(file_id)
+        return (
+            file_obj.purpose in _IMAGE_FILE_PURPOSES
+            and (file_obj.filename or "").lower().endswith(_IMAGE_FILE_EXTENSIONS)
+        )
+
+    return await image_check_cache.get_or_set(file_id, check)
+
+async def fetch_file_bytes(file_id: str) -> bytes:
+    """
+    The content of an OpenAI file, downloaded once and then served from file_cache.
+    """
+    async def download() -> bytes:
+        file_bytes, _ = await _stream_file(file_id)
+        return file_bytes
+
+    return await file_cache.get_or_set(file_id, download)
+
+async def fetch_file_b64(file_id: str) -> str:
+    """
+    The content of an OpenAI file as base64, encoded once and then served from file_b64_cache.
+    """
+    async def encode() -> str:
+        file_bytes = file_cache.cache.get(file_id)
+        if file_bytes is not None:
+            # b2a_base64 is what b64encode wraps, called directly and decoded as ASCII (all base64 is)
+            return binascii.b2a_base64(file_bytes, newline=False).decode("ascii")
+
+        # not downloaded yet: encode while it downloads, and keep the bytes for /images too
+        file_bytes, b64 = await _stream_file(file_id, encode_b64=True)
+        file_cache.set(file_id, file_bytes)
+        return b64
+
+    return await file_b64_cache.get_or_set(file_id, encode)
+
+async def _stream_file(file_id: str, encode_b64: bool = False) -> Tuple[bytes, Optional[str]]:
+    """
+    Download an OpenAI file in FILE_STREAM_CHUNK pieces instead of waiting for the whole body.
+    With encode_b64, the base64 is built while the rest is still arriving: base64 of
+    3-byte-aligned pieces concatenates into the base64 of the whole, so only the 0-2
+    leftover bytes of each chunk are carried over to the next.
+
+    :return: (file bytes, base64 string or None)
+    """
+    chunks = []
+    b64_parts = []
+    pending = b""
+    async with openai_client.files.with_streaming_response.content(file_id) as resp:
+        async for chunk in resp.iter_bytes(FILE_STREAM_CHUNK):
+            chunks.append(chunk)
+            if encode_b64:
+                data = pending + chunk if pending else chunk
+                cut = len(data) - len(data) % 3
+                b64_parts.append(binascii.b2a_base64(memoryview(data)[:cut], newline=False))
+                pending = data[cut:]
+
+    if not encode_b64:
+        return b"".join(chunks), None
+    b64_parts.append(binascii.b2a_base64(pending, newline=False))
+    return b"".join(chunks), b"".join(b64_parts).decode("ascii")
+
+def _image_mimetype(data: bytes) -> str:
+    # code interpreter charts are PNG, but check the magic bytes rather than assume
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    return "application/octet-stream"
+
+# For local runs (the container runs hypercorn with uvloop workers, see the dockerfile)
 if __name__ == "__main__":
-    app.run(debug=True, port=int(os.getenv("PORT", 5000)))
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    # debug mode adds per-request overhead, only turn it on for development
+    app.run(debug=os.getenv("ENV") == "dev", port=int(os.getenv("PORT", 5000)))
 
@@ -0,0 +1,54 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+_MISSING = object()
+
+
+class SingleFlightCache:
+    """
+    Small async wrapper around a cachetools cache (LRUCache, TTLCache, ...).
+    Concurrent misses on the same key share one call to the factory, so a burst
+    of identical requests only does the expensive work once.
+    Failed calls are not cached.
+    """
+
+    def __init__(self, cache, should_cache: Optional[Callable[[Any], bool]] = None):
+        """
+        :param cache: any cachetools cache instance, e.g. LRUCache(maxsize=256)
+        :param should_cache: optional predicate, values it rejects are returned but not stored
+        """
+        self.cache = cache
+        self.should_cache = should_cache
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    async def get_or_set(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Return the cached value for `key`, or await `factory()` to produce and store it.
+        """
+        value = self.cache.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._fill(key, factory))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _, key=key: self._inflight.pop(key, None))
+
+        # shield so one caller being cancelled doesn't cancel the fill for the others
+        return await asyncio.shield(future)
+
+    async def _fill(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        value = await factory()
+        self.set(key, value)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        Store a value produced elsewhere (subject to should_cache).
+        """
+        if self.should_cache is None or self.should_cache(value):
+            self.cache[key] = value
+
+    def clear(self) -> None:
+        self.cache.clear()
@@ -1,43 +1,168 @@
+import asyncio
 import json
-import csv
-from io import StringIO
+from io import BytesIO, StringIO
+from typing import List, Union
+import asyncpg
 import sqlalchemy
-from sqlalchemy.ext.asyncio import AsyncEngine
+from contextlib import asynccontextmanager
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+try:
+    # orjson serializes several times faster than the stdlib
+    import orjson
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj, default=str).decode("utf-8")
+except ImportError:
+    def json_dumps(obj) -> str:
+        return json.dumps(obj, default=str)
+
+# Results with more rows than this are serialized in a worker thread
+OFFLOAD_ROWS = 1000
+
+# Rows fetched and serialized per step when streaming a result
+STREAM_PARTITION_ROWS = 1000
+
+# CSV is produced by Postgres itself (COPY ... TO STDOUT), "csv_bytes" returns it as bytes
+# for callers like file uploads that need bytes anyway, "csv" decodes it
+OUTPUT_FORMATS = ("json", "csv", "csv_bytes")
 
 async def execute_sql_query_async(
-    engine: AsyncEngine,
+    engine: Union[AsyncEngine, AsyncConnection],
+    query: str,
+    output_format: str = "csv"
+) -> Union[str, bytes]:
+    """
+    Executes a SQL query using an async SQLAlchemy engine (or an already open connection,
+    to run several queries in a row on one checkout), returns data as JSON or CSV string
+    (or CSV bytes for "csv_bytes").
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Invalid output_format. Must be 'json', 'csv' or 'csv_bytes'.")
+
+    async with _connect(engine) as conn:
+        if output_format != "json":
+            # CSV is written by Postgres itself (COPY), the engine runs on asyncpg,
+            # so COPY goes straight through its driver connection
+            raw = await conn.get_raw_connection()
+            csv_bytes = await _copy_csv_bytes(raw.driver_connection, query)
+            return csv_bytes if output_format == "csv_bytes" else csv_bytes.decode("utf-8")
+
+        # Stream the rows with a server-side cursor and serialize them as they arrive,
+        # so the whole result never sits in memory as row objects. The loop is only held
+        # for one partition at a time.
+        result = await conn.stream(sqlalchemy.text(query))
+        colnames = list(result.keys())
+
+        # one dumps call per partition, its [ ] are replaced by the outer array's.
+        # Plain Rows are zipped with the column names once, no RowMapping is built in between.
+        output = StringIO()
+        output.write("[")
+        first = True
+        async for partition in result.partitions(STREAM_PARTITION_ROWS):
+            if not first:
+                output.write(",")
+            output.write(json_dumps([dict(zip(colnames, row)) for row in partition])[1:-1])
+            first = False
+        output.write("]")
+
+    return output.getvalue()
+
+
+@asynccontextmanager
+async def _connect(engine_or_conn: Union[AsyncEngine, AsyncConnection]):
+    """
+    Check out a connection from an engine, or use the caller's open connection as is
+    (the caller keeps ownership and closes it).
+    """
+    if isinstance(engine_or_conn, AsyncConnection):
+        yield engine_or_conn
+    else:
+        async with engine_or_conn.connect() as conn:
+            yield conn
+
+
+async def execute_sql_query_asyncpg(
+    pool: asyncpg.Pool,
     query: str,
     output_format: str = "csv"
-) -> str:
-    """
-    Executes a SQL query using an async SQLAlchemy engine,
-    returns data as JSON or CSV string.
-    """
-    if output_format not in ("json", "csv"):
-        raise ValueError("Invalid output_format. Must be 'json' or 'csv'.")
-
-    async with engine.connect() as conn:
-        # Execute query
-        result = await conn.execute(sqlalchemy.text(query))
-
-        # 'result.mappings()' returns RowMapping objects
-        rows = result.mappings().all()
-
-        if not rows:
-            colnames = []
-        else:
-            colnames = list(rows[0].keys())
-
-        if output_format == "json":
-            # Convert RowMapping -> dict
-            # Then dump to JSON
-            data_dicts = [dict(r) for r in rows]
-            return json.dumps(data_dicts, default=str)
-        else:
-            # CSV
-            output = StringIO()
-            writer = csv.DictWriter(output, fieldnames=colnames, quoting=csv.QUOTE_MINIMAL)
-            writer.writeheader()
-            for row_map in rows:
-                writer.writerow(dict(row_map))
-            return output.getvalue()
+) -> Union[str, bytes]:
+    """
+    Executes a SQL query on a raw asyncpg pool (no SQLAlchemy layer),
+    returns data as JSON or CSV string (or CSV bytes for "csv_bytes").
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Invalid output_format. Must be 'json', 'csv' or 'csv_bytes'.")
+
+    async with pool.acquire() as conn:
+        if output_format != "json":
+            # CSV is written by Postgres itself (COPY)
+            csv_bytes = await _copy_csv_bytes(conn, query)
+            return csv_bytes if output_format == "csv_bytes" else csv_bytes.decode("utf-8")
+
+        rows = await conn.fetch(query)
+
+    if len(rows) > OFFLOAD_ROWS:
+        return await asyncio.to_thread(_records_to_json, rows)
+    return _records_to_json(rows)
+
+
+async def _copy_csv_bytes(conn: asyncpg.Connection, query: str) -> bytes:
+    """
+    Let Postgres write the CSV (header included) and collect the raw bytes,
+    no Python objects are built per row or cell.
+    """
+    buf = BytesIO()
+
+    async def write(chunk: bytes) -> None:
+        buf.write(chunk)
+
+    # a trailing ; isn't allowed inside COPY (...)
+    query = query.strip().rstrip(";")
+    await conn.copy_from_query(query, output=write, format="csv", header=True)
+    return buf.getvalue()
+
+
+def _records_to_json(rows) -> str:
+    return json_dumps([dict(r) for r in rows])
+
+
+async def execute_sql_queries_batched_async(
+    engine: Union[AsyncEngine, AsyncConnection],
+    queries: List[str]
+) -> List[str]:
+    """
+    Executes several read-only SELECT queries in a single round-trip, returns one JSON string each.
+    Each query becomes one json_agg column of a single SELECT, so Postgres sends back
+    one row holding every result set, which is then split back per query.
+    Only meant for queries with small results (everything is returned in one row),
+    and values come back JSON-typed (e.g. timestamps in ISO format).
+    CSV isn't batched, it is written by COPY, one statement per query.
+    """
+    async with _connect(engine) as conn:
+        result = await conn.execute(sqlalchemy.text(_batched_select(queries)))
+        row = result.one()
+
+    return list(row)
+
+
+async def execute_sql_queries_batched_asyncpg(
+    pool: asyncpg.Pool,
+    queries: List[str]
+) -> List[str]:
+    """
+    Same as execute_sql_queries_batched_async, on a raw asyncpg pool.
+    """
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(_batched_select(queries))
+
+    return list(row)
+
+
+def _batched_select(queries: List[str]) -> str:
+    columns = []
+    for i, query in enumerate(queries):
+        # a trailing ; would end the outer statement early
+        query = query.strip().rstrip(";")
+        columns.append(f"(SELECT coalesce(json_agg(t), '[]'::json)::text FROM ({query}) AS t) AS q{i}")
+    return "SELECT " + ",\n       ".join(columns)
@@ -31,20 +31,19 @@ def main():
             continue
 
         data = add_msg_resp.json()
-        # data is expected to be { "messages": [ { "role":"assistant" or "user", "text":"...", "image": ...}, ... ] }
+        # data is expected to be { "messages": [ { "role":"assistant" or "user", "text":"...", "image_url": ...}, ... ] }
 
         messages = data.get("messages", [])
         print("\n--- Agent Response ---")
         for i, msg in enumerate(messages):
             role = msg.get("role")
             text = msg.get("text", "")
-            img_b64 = msg.get("image", None)
+            image_url = msg.get("image_url", None)
 
             print(f"{i+1}) role={role}\n   text={text}")
-            if img_b64:
-                # Just print the first ~50 characters of the base64 to confirm presence
-                snippet = img_b64[:50] + "..."
-                print(f"   (image base64 snippet)={snippet}")
+            if image_url:
+                # The image itself is served separately by the /images route
+                print(f"   (image)={server_url}{image_url}")
         print("-----------------------\n")
 
 if __name__ == "__main__":
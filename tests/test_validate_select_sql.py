@@ -0,0 +1,22 @@
+import unittest
+
+from Agents.AsyncSQLQueryGeneratorAgent import SQLValidationError, starts_like_sql, validate_select_sql
+
+
+class ValidateSelectSQLTest(unittest.TestCase):
+
+    def test_parenthesized_select_is_accepted(self):
+        # starts_like_sql lets "(SELECT" through, so validation must accept it too
+        self.assertTrue(starts_like_sql("(SELECT 1)"))
+        validate_select_sql("(SELECT 1)")
+        validate_select_sql("((SELECT 1))")
+
+    def test_parenthesized_write_is_rejected(self):
+        with self.assertRaises(SQLValidationError):
+            validate_select_sql("(SELECT 1) FOR UPDATE")
+        with self.assertRaises(SQLValidationError):
+            validate_select_sql("(SELECT * INTO t2 FROM t)")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -18,6 +18,23 @@ def get_connection(database_name: str):
     :return: A SQLAlchemy connection object.
     """
 
+    # Return a brand-new connection from a temporary engine
+    # (The engine and connector will be garbage-collected if not stored)
+    return get_engine(database_name).connect()
+
+
+def get_engine(database_name: str, pool_size: int = 4, max_overflow: int = 12) -> sqlalchemy.Engine:
+    """
+    Creates and returns a pooled SQLAlchemy engine using the Cloud SQL Python Connector
+    (same environment variables as get_connection). Keep the engine around and check out
+    a connection per query, so concurrent queries run on separate connections.
+
+    :param database_name: The name of the PostgreSQL database to connect to (e.g. "statcast").
+    :param pool_size: connections kept open in the pool
+    :param max_overflow: extra connections opened under load (pool_size + max_overflow at most)
+    :return: A SQLAlchemy Engine.
+    """
+
     # Read environment variables
     instance_conn_name = os.getenv("INSTANCE_CONNECTION_NAME", "")
     db_user = os.getenv("DB_USER", "readonly_user")
@@ -44,13 +61,11 @@ def get_connection(database_name: str):
             ip_type=ip_type,
         )
 
-    # Create a temporary Engine with the 'creator' callback
-    engine = sqlalchemy.create_engine(
+    # Create an Engine with the 'creator' callback
+    return sqlalchemy.create_engine(
         "postgresql+pg8000://",
         creator=getconn,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_pre_ping=True
     )
-
-    # Return a brand-new connection from the engine
-    # (The engine and connector will be garbage-collected if not stored)
-    return engine.connect()
-
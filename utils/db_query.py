@@ -1,8 +1,18 @@
 import json
 import csv
-from io import StringIO
+from io import BytesIO, StringIO
 import sqlalchemy
 
+try:
+    # orjson serializes several times faster than the stdlib
+    import orjson
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj, default=str).decode("utf-8")
+except ImportError:
+    def json_dumps(obj) -> str:
+        return json.dumps(obj, default=str)
+
 def execute_sql_query(conn, query: str, output_format: str = "json") -> str:
     """
     Executes a SQL query using a given SQLAlchemy connection 'conn'.
@@ -14,31 +24,46 @@ def execute_sql_query(conn, query: str, output_format: str = "json") -> str:
 
     try:
         result = conn.execute(sqlalchemy.text(query))
-        # Use 'mappings()' to get each row as a dictionary
-        rows = result.mappings().all()  # a list of RowMapping objects
-
-        # Convert RowMapping objects to plain dictionaries (optional)
-        # rows = [dict(r) for r in result.mappings().all()]
-
-        if not rows:
-            colnames = []
-        else:
-            # If we kept them as row mappings, we can do:
-            colnames = list(rows[0].keys())
+        # Plain Rows are tuples in column order, the column names come from the result
+        # itself (so an empty result still has its CSV header)
+        colnames = list(result.keys())
+        rows = result.all()
 
         # Return data as JSON
         if output_format == "json":
-            return json.dumps(rows, default=str)
+            # a Row isn't a dict, neither json nor orjson would serialize it as an object
+            return json_dumps([dict(zip(colnames, row)) for row in rows])
 
         # Or return data as CSV
         else:
+            # csv.writer takes the tuples as they are, no per-row dict checks like DictWriter
             output = StringIO()
-            writer = csv.DictWriter(output, fieldnames=colnames, quoting=csv.QUOTE_MINIMAL)
-            writer.writeheader()
-            for row_map in rows:
-                writer.writerow(row_map)
+            writer = csv.writer(output, quoting=csv.QUOTE_MINIMAL)
+            writer.writerow(colnames)
+            writer.writerows(rows)
             return output.getvalue()
 
     except Exception as e:
         raise RuntimeError(f"Error executing query: {e}") from e
 
+
+def execute_sql_query_copy(conn, query: str) -> bytes:
+    """
+    Executes a SQL query with COPY (query) TO STDOUT WITH CSV HEADER on the given SQLAlchemy
+    connection 'conn' (pg8000 driver), so Postgres writes the CSV itself.
+    Returns the CSV as bytes, no Python objects are built per row or cell.
+    """
+    # a trailing ; isn't allowed inside COPY (...)
+    query = query.strip().rstrip(";")
+
+    try:
+        buf = BytesIO()
+        cursor = conn.connection.driver_connection.cursor()
+        try:
+            cursor.execute(f"COPY ({query}) TO STDOUT WITH CSV HEADER", stream=buf)
+        finally:
+            cursor.close()
+        return buf.getvalue()
+
+    except Exception as e:
+        raise RuntimeError(f"Error executing query: {e}") from e